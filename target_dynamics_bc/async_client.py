@@ -0,0 +1,223 @@
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import singer
+
+from target_dynamics_bc.client import DynamicsClient
+from target_dynamics_bc.utils import EntityCache
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+LOGGER = singer.get_logger()
+
+class AsyncDynamicsClient:
+    """
+    asyncio version of the DynamicsClient requests, used to keep many batch requests in flight
+    without one thread per request. The requests are built by the DynamicsClient it wraps, which
+    also provides the auth, the retry settings and the environment rate limiter.
+
+    max_concurrency limits the number of requests in flight at the same time.
+
+    Usage:
+        async with AsyncDynamicsClient(dynamics_client) as client:
+            responses = await client.make_batch_request(requests_data)
+
+    Or from synchronous code, in an event loop kept for the whole run so the session and
+    its connections are reused by every call:
+        responses = client.run(lambda client: client.make_batch_request(requests_data))
+        client.close()
+    """
+    def __init__(self, client: DynamicsClient, max_concurrency: Optional[int] = None) -> None:
+        if aiohttp is None:
+            raise ImportError("aiohttp is required to use the async client. Install target-dynamics-bc[async]")
+
+        self.client = client
+        self.max_concurrency = max_concurrency or int(client.config.get("max_concurrency", 10))
+        self.session = None
+        self.semaphore = None
+        self.loop = None
+        self._loop_thread = None
+        self._loop_lock = threading.Lock()
+
+    async def __aenter__(self):
+        # the semaphore needs to be created inside the running event loop
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency))
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+
+    def run(self, coroutine_function: Callable[["AsyncDynamicsClient"], Awaitable]):
+        """
+        Runs coroutine_function with the client and returns its result. It runs in the event loop of
+        the client, which is started on the first call and runs in its own thread until close is called,
+        so it can be called from any thread
+        """
+        with self._loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self.loop.run_forever, name="dynamics-async-client", daemon=True)
+                self._loop_thread.start()
+                asyncio.run_coroutine_threadsafe(self.__aenter__(), self.loop).result()
+
+        return asyncio.run_coroutine_threadsafe(coroutine_function(self), self.loop).result()
+
+    def close(self):
+        """Closes the session and stops the event loop started by run"""
+        with self._loop_lock:
+            if self.loop is None:
+                return
+
+            try:
+                asyncio.run_coroutine_threadsafe(self.__aexit__(), self.loop).result()
+            finally:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self._loop_thread.join()
+                self.loop.close()
+                self.loop = None
+
+    async def _get_access_token(self) -> str:
+        # refreshing the token is a blocking request, run it in a thread to not block the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.client.auth.get_access_token)
+
+    async def _make_request(self, endpoint: str, method: str, data=None, headers=None, retry_connection_errors: Optional[bool] = None) -> Tuple[int, dict]:
+        request_headers = {"Content-Type": "application/json"}
+        if headers:
+            request_headers.update(headers)
+
+        url = self.client.url + endpoint
+        json_data = self.client.codec.dumps(data) if data else None
+
+        # same as DynamicsClient._make_request, requests that write are only retried if they couldn't connect
+        if retry_connection_errors is None:
+            retry_connection_errors = method == "GET"
+
+        for attempt in range(self.client.max_retries + 1):
+            await self.client.rate_limiter.acquire_async()
+            request_headers["Authorization"] = f"Bearer {await self._get_access_token()}"
+
+            # the semaphore is only held while the request is in flight, not while waiting to retry it
+            try:
+                async with self.semaphore:
+                    async with self.session.request(method, url, data=json_data, headers=request_headers) as response:
+                        status = response.status
+                        retry_after = response.headers.get("Retry-After")
+                        content = await response.read()
+                # decoded with the same codec as DynamicsClient, errors without a json body are kept as text
+                try:
+                    body = self.client.codec.loads(content)
+                except ValueError:
+                    body = content.decode(errors="replace")
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= self.client.max_retries or not (retry_connection_errors or isinstance(e, aiohttp.ClientConnectorError)):
+                    raise
+                delay = self.client._get_retry_delay(attempt)
+                LOGGER.warning(f"{method} {endpoint} failed with {e}. Retrying in {delay:.1f}s ({attempt + 1}/{self.client.max_retries})")
+                await asyncio.sleep(delay)
+                continue
+
+            if status == 429:
+                self.client.rate_limiter.on_throttle()
+            elif status < 500:
+                self.client.rate_limiter.on_success()
+
+            if status not in self.client.retryable_status_codes or attempt >= self.client.max_retries:
+                return status, body
+
+            delay = self.client._get_retry_delay(attempt, retry_after)
+            LOGGER.warning(f"{method} {endpoint} returned status={status}. Retrying in {delay:.1f}s ({attempt + 1}/{self.client.max_retries})")
+            await asyncio.sleep(delay)
+
+    async def _send_batch_request(self, requests_data: List[dict], headers: dict) -> List[dict]:
+        request_data = DynamicsClient.build_batch_request_data(requests_data)
+        _, body = await self._make_request("$batch", "POST", data=request_data, headers=headers, retry_connection_errors=DynamicsClient.is_read_only_batch(requests_data))
+        return body.get("responses", []) if isinstance(body, dict) else []
+
+    async def _send_batch_request_with_retries(self, requests_data: List[dict], headers: dict, transaction_type: str) -> List[dict]:
+        """Same as DynamicsClient._send_batch_request_with_retries"""
+        responses = await self._send_batch_request(requests_data, headers)
+
+        for attempt in range(self.client.max_retries):
+            throttled_responses = [response for response in responses if response.get("status") in self.client.retryable_status_codes]
+            if not throttled_responses:
+                break
+
+            if any(response.get("status") == 429 for response in throttled_responses):
+                self.client.rate_limiter.on_throttle()
+
+            delay = max(self.client._get_retry_delay(attempt, DynamicsClient._get_header(response, "Retry-After")) for response in throttled_responses)
+            LOGGER.warning(f"{len(throttled_responses)} batch requests were throttled. Retrying in {delay:.1f}s ({attempt + 1}/{self.client.max_retries})")
+            await asyncio.sleep(delay)
+
+            if transaction_type == "atomic":
+                responses = await self._send_batch_request(requests_data, headers)
+                continue
+
+            throttled_ids = {response.get("id") for response in throttled_responses}
+            retried_responses = await self._send_batch_request(DynamicsClient.get_retry_requests(requests_data, responses, throttled_ids), headers)
+            retried_responses_by_id = {response.get("id"): response for response in retried_responses}
+            responses = [retried_responses_by_id.get(response.get("id"), response) for response in responses]
+
+        return responses
+
+    async def make_batch_request(self, requests_data: List[dict], transaction_type: str = "non_atomic") -> List[dict]:
+        """Same as DynamicsClient.make_batch_request, but the chunks of a big batch are sent concurrently"""
+        headers = DynamicsClient.get_batch_headers(transaction_type)
+        requests_data = DynamicsClient.assign_request_ids(requests_data)
+
+        chunks_responses = await asyncio.gather(*[
+            self._send_batch_request_with_retries(requests_chunk, headers, transaction_type)
+            for requests_chunk in self.client.chunk_batch_requests(requests_data, transaction_type)
+        ])
+
+        return [response for chunk_responses in chunks_responses for response in chunk_responses]
+
+    async def get_entities(self, record_type: str, url_params: Optional[dict] = {}, filters: Optional[Dict[str, List]] = {}, expand: str = None):
+        """Same as DynamicsClient.get_entities, the chunks of the requests and of their next pages are sent concurrently"""
+        requests_data = self.client.build_get_entities_requests(record_type, url_params, filters, expand)
+        pending_requests = self.client.prepare_page_requests(requests_data)
+
+        entities = []
+        while pending_requests:
+            responses = await self.make_batch_request(pending_requests)
+            for response in responses:
+                success, error_message = self.client._validate_batch_response(response)
+                if not success:
+                    return success, error_message, entities
+                entities += response.get("body", {}).get("value", [])
+
+            pending_requests = self.client.get_next_page_requests(pending_requests, responses)
+
+        return True, None, entities
+
+    async def get_existing_entities_for_records(self, companies_reference_data: List[Dict], record_type: str, records: List[Dict], filter_mappings: List[Dict], expand: Optional[str] = None, entity_cache: Optional[EntityCache] = None) -> Dict[str, List]:
+        """Same as DynamicsClient.get_existing_entities_for_records, but the companies are queried concurrently"""
+        company_entities_mapping = DynamicsClient.map_records_filters_to_companies(companies_reference_data, records, filter_mappings)
+
+        async def get_company_entities(company_id: str) -> List[dict]:
+            filters = company_entities_mapping[company_id]
+
+            cached_entities = []
+            if entity_cache:
+                filters, cached_entities = DynamicsClient.split_cached_filters(entity_cache, record_type, company_id, filters, filter_mappings, expand)
+
+            entities = []
+            if any(filters.values()):
+                success, _, entities = await self.get_entities(record_type, url_params={"companyId": company_id}, filters=filters, expand=expand)
+                if entity_cache and success:
+                    DynamicsClient.cache_filters_entities(entity_cache, record_type, company_id, filters, filter_mappings, entities, expand)
+
+            # entities matching cached and queried filter values are only returned once
+            queried_ids = {entity.get("id") for entity in entities}
+            return entities + [entity for entity in cached_entities if entity["id"] not in queried_ids]
+
+        company_ids = list(company_entities_mapping.keys())
+        companies_entities = await asyncio.gather(*[get_company_entities(company_id) for company_id in company_ids])
+
+        return dict(zip(company_ids, companies_entities))
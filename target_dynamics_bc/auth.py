@@ -1,5 +1,6 @@
 import requests
 import json
+import threading
 from datetime import datetime, timedelta
 
 class DynamicsAuth(requests.auth.AuthBase):
@@ -14,9 +15,21 @@ class DynamicsAuth(requests.auth.AuthBase):
         self.__session = requests.Session()
         self.__access_token = None
         self.__expires_at = None
+        self.__lock = threading.Lock()
+
+    def __is_token_valid(self):
+        expires_at = self.__expires_at
+        return self.__access_token is not None and expires_at is not None and expires_at > datetime.utcnow()
 
     def ensure_access_token(self):
-        if self.__access_token is None or self.__expires_at <= datetime.utcnow():
+        if self.__is_token_valid():
+            return
+
+        # only one thread refreshes the token, the others wait and reuse the refreshed token
+        with self.__lock:
+            if self.__is_token_valid():
+                return
+
             response = self.__session.post(
                 "https://login.microsoftonline.com/common/oauth2/token",
                 data={
@@ -44,6 +57,10 @@ class DynamicsAuth(requests.auth.AuthBase):
                 seconds=int(data["expires_in"]) - 10
             )  # pad by 10 seconds for clock drift
 
+    def get_access_token(self) -> str:
+        self.ensure_access_token()
+        return self.__access_token
+
     def __call__(self, r):
         self.ensure_access_token()
         r.headers["Authorization"] = "Bearer {}".format(self.__access_token)
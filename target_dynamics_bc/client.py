@@ -1,14 +1,25 @@
-import json
+import random
+import time
 import requests
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
 
 from target_dynamics_bc.mappers.base_mappers import BaseMapper
-from target_hotglue.common import HGJSONEncoder
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 import singer
 
 
 from target_dynamics_bc.auth import DynamicsAuth
-from target_dynamics_bc.utils import extract_error_message
+from target_dynamics_bc.json_codec import get_codec
+from target_dynamics_bc.rate_limiter import get_rate_limiter
+from target_dynamics_bc.utils import EntityCache, EntityIndexCache, InvalidConfigurationError, extract_error_message
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 LOGGER = singer.get_logger()
 
@@ -33,17 +44,106 @@ class DynamicsClient:
         "vendorPaymentsDimensionSetLines": "companies({companyId})/vendorPaymentJournals({parentId})/vendorPayments({entityId})/dimensionSetLines"
     }
 
+    # fields the target reads from the entities of each record type and from the expanded entities
+    # (keyed by their navigation property). With select_fields only these fields are requested ($select).
+    # Customers and Vendors include every field their mappers upsert, as skip_unchanged_records compares them
+    ref_request_select = {
+        "Accounts": ["id", "number", "displayName", "lastModifiedDateTime"],
+        "Locations": ["id", "code", "displayName", "lastModifiedDateTime"],
+        "Items": ["id", "number", "displayName"],
+        "Currencies": ["id", "code", "displayName", "lastModifiedDateTime"],
+        "PaymentMethods": ["id", "code", "displayName", "lastModifiedDateTime"],
+        "Customers": [
+            "id", "number", "displayName", "type", "email", "website", "taxLiable", "blocked", "phoneNumber", "paymentMethodId",
+            "addressLine1", "addressLine2", "city", "state", "country", "postalCode", "currencyId", "currencyCode"
+        ],
+        "Vendors": [
+            "id", "number", "displayName", "email", "website", "blocked", "phoneNumber",
+            "addressLine1", "addressLine2", "city", "state", "country", "postalCode", "currencyId", "currencyCode"
+        ],
+        "Dimensions": ["id", "code", "displayName"],
+        "purchaseInvoices": ["id", "number", "vendorInvoiceNumber", "vendorId", "status"],
+        "Journals": ["id", "code", "displayName"],
+        "vendorPaymentJournals": ["id", "code"],
+        "vendorPayments": ["id", "journalId", "documentNumber"],
+        "dimensionValues": ["id", "code", "displayName", "dimensionId"],
+        "defaultDimensions": ["id", "dimensionId", "dimensionValueId"],
+        "dimensionSetLines": ["id", "valueId"],
+        "purchaseInvoiceLines": ["id", "sequence", "description", "itemId"]
+    }
+
+    # reference data loaded for every company, keyed by the Company field it's stored in
+    # incremental collections have lastModifiedDateTime so cached data can be revalidated
+    # by only fetching what changed since the last load
+    company_reference_collections = {
+        "currencies": {"record_type": "Currencies", "incremental": True},
+        "paymentMethods": {"record_type": "PaymentMethods", "incremental": True},
+        "dimensions": {"record_type": "Dimensions", "expand": "dimensionValues", "incremental": False},
+        "accounts": {"record_type": "Accounts", "incremental": True},
+        "locations": {"record_type": "Locations", "incremental": True}
+    }
+
+    # max number of operations Dynamics accepts in one $batch request
+    max_batch_operations = 100
+
+    # throttled or temporarily unavailable, these are retried with backoff. 504 is not retried as the
+    # request could have been applied after the gateway timed out, retrying writes would duplicate them
+    retryable_status_codes = [429, 503]
+
     def __init__(self, target) -> None:
         self.config = target.config
+        self.max_batch_operations = int(self.config.get("max_batch_operations", self.max_batch_operations))
+        self.max_retries = int(self.config.get("max_retries", 5))
+        self.retry_backoff_factor = float(self.config.get("retry_backoff_factor", 1))
+        self.max_retry_delay = float(self.config.get("max_retry_delay", 60))
         environment = self.config.get("environment_name")
         self.url = self.config.get("full_url", f"https://api.businesscentral.dynamics.com/v2.0/{environment}/api/v2.0/")
         self.auth = DynamicsAuth(target)
+        self.session = self._create_session()
+        # request bodies and batch responses are encoded and decoded with a fast json library when installed
+        self.codec = get_codec(self.config.get("json_codec"))
+        # the responses of the GET batch requests are parsed as they are read instead of loading the whole body
+        self.stream_batch_responses = bool(self.config.get("stream_batch_responses"))
+        if self.stream_batch_responses and ijson is None:
+            LOGGER.warning("ijson is required to stream batch responses. Install target-dynamics-bc[stream]. Batch responses will be fully loaded")
+            self.stream_batch_responses = False
+        # Dynamics limits the request rate per environment, so the limiter is shared by environment.
+        # requests are only paced with rate_limit, otherwise throttled requests are just retried
+        try:
+            rate_limit = float(self.config.get("rate_limit") or 0)
+            self.rate_limiter = get_rate_limiter(
+                self.url,
+                rate=rate_limit or None,
+                min_rate=float(self.config.get("min_rate_limit", 0.5)),
+                max_rate=float(self.config.get("max_rate_limit", max(20, rate_limit)))
+            )
+        except ValueError as e:
+            raise InvalidConfigurationError(f"Invalid rate limit config: {e}")
 
-    def get_auth(self):
-        r = requests.Session()
-        return self.auth(r)
+    def _create_session(self) -> requests.Session:
+        """
+        Creates the long lived session shared by every request made by the client, so
+        the TCP/TLS connections to Dynamics are kept alive and reused across requests
+        """
+        pool_connections = int(self.config.get("pool_connections", 10))
+        # every worker upserting records concurrently needs its own connection
+        pool_maxsize = int(self.config.get("pool_maxsize", max(10, int(self.config.get("max_workers", 1)))))
+
+        session = requests.Session()
+        # pool_connections is the number of hosts we keep a pool for and pool_maxsize is
+        # the max number of connections kept alive per host
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"Connection": "keep-alive"})
+        return session
+
+    def close(self):
+        """Closes the pooled session and all the connections kept alive by it"""
+        LOGGER.info(f"Rate limiter metrics: {self.rate_limiter.get_metrics()}")
+        self.session.close()
     
-    def _make_request(self, endpoint, method, data=None, params=None, headers=None):
+    def _make_request(self, endpoint, method, data=None, params=None, headers=None, stream=False, retry_connection_errors=None):
         request_headers = {"Content-Type": "application/json"}
         if headers:
             request_headers.update(headers)
@@ -51,18 +151,71 @@ class DynamicsClient:
         url = self.url + endpoint
         request_params = params or {}
 
-        request = self.get_auth()
-        request.headers.update(request_headers)
+        json_data = self.codec.dumps(data) if data else None
+
+        # a dropped connection or a read timeout could happen after the request was applied, so only
+        # requests that don't write are retried. Connect timeouts are always retried, nothing was sent
+        if retry_connection_errors is None:
+            retry_connection_errors = method == "GET"
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                # headers are sent per request so they don't leak into the shared session
+                response = self.session.request(
+                    method=method,
+                    url=url,
+                    params=request_params,
+                    data=json_data,
+                    headers=request_headers,
+                    auth=self.auth,
+                    verify=True,
+                    stream=stream
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self.max_retries or not (retry_connection_errors or isinstance(e, requests.exceptions.ConnectTimeout)):
+                    raise
+                delay = self._get_retry_delay(attempt)
+                LOGGER.warning(f"{method} {endpoint} failed with {e}. Retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                time.sleep(delay)
+                continue
+
+            if response.status_code == 429:
+                self.rate_limiter.on_throttle()
+            elif response.status_code < 500:
+                self.rate_limiter.on_success()
+
+            if self.rate_limiter.requests % 500 == 0:
+                LOGGER.info(f"Rate limiter metrics: {self.rate_limiter.get_metrics()}")
+
+            if response.status_code not in self.retryable_status_codes or attempt >= self.max_retries:
+                return response
 
-        json_data = json.dumps(data, cls=HGJSONEncoder) if data else None
+            delay = self._get_retry_delay(attempt, response.headers.get("Retry-After"))
+            LOGGER.warning(f"{method} {endpoint} returned status={response.status_code}. Retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+            # releases the connection of a streamed response that won't be read
+            response.close()
+            time.sleep(delay)
 
-        return request.request(
-            method=method,
-            url=url,
-            params=request_params,
-            data=json_data,
-            verify=True
-        )
+    def _get_retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """
+        Uses the Retry-After sent by Dynamics when there is one (either in seconds or as a
+        http date), otherwise uses exponential backoff with jitter
+        """
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_retry_delay)
+            except ValueError:
+                pass
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                return min(max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0), self.max_retry_delay)
+            except (TypeError, ValueError):
+                pass
+
+        delay = min(self.retry_backoff_factor * (2 ** attempt), self.max_retry_delay)
+        # jitter spreads the retries so concurrent requests don't retry all at the same time
+        return delay / 2 + random.uniform(0, delay / 2)
     
     def _validate_response(self, response: requests.Response) -> Tuple[bool, Optional[str]]:
         if response.status_code >= 400:
@@ -92,14 +245,211 @@ class DynamicsClient:
                         to be used when multiple requests are needed for one entity, for example updating
                         Customer and it's default dimensions
         """
-        headers = {"Prefer": "odata.continue-on-error=true"}
+        headers = self.get_batch_headers(transaction_type)
+        requests_data = self.assign_request_ids(requests_data)
 
+        responses = []
+        for requests_chunk in self.chunk_batch_requests(requests_data, transaction_type):
+            responses += self._send_batch_request_with_retries(requests_chunk, headers, transaction_type)
+
+        return responses
+
+    @staticmethod
+    def get_batch_headers(transaction_type: str) -> dict:
         if transaction_type == "atomic":
             # Prefer: odata.continue-on-error=false makes the batch request stop processing requests if one of them fail
             # Isolation: snapshot makes the batch request atomic, if one of the requests fail the operation will be rolled back
             # it's good to be used when multiple requests are needed for one entity, for example updating Customer and it's default dimensions
-            headers = {"Isolation": "snapshot", "Prefer": "odata.continue-on-error=false"}
+            return {"Isolation": "snapshot", "Prefer": "odata.continue-on-error=false"}
+
+        return {"Prefer": "odata.continue-on-error=true"}
 
+    @staticmethod
+    def assign_request_ids(requests_data: List[dict]) -> List[dict]:
+        """Every request needs an id so throttled responses can be matched to their request and retried"""
+        return [
+            request if request.get("request_id") else {**request, "request_id": f"_request_{index}"}
+            for index, request in enumerate(requests_data)
+        ]
+
+    def chunk_batch_requests(self, requests_data: List[dict], transaction_type: str) -> List[List[dict]]:
+        """
+        Dynamics limits the number of operations per batch request, bigger batches are split
+        in chunks. Chunks are in the same order of the requests so the responses can be merged back
+        """
+        # an atomic batch can't be split without losing its atomicity
+        if transaction_type == "atomic":
+            return [requests_data]
+
+        # requests that depend on other requests (dependsOn) or are in the same atomicity group need
+        # to be in the same batch, so a chunk can only end where no later request depends on a request
+        # of the chunk or is in the same atomicity group as one of them
+        positions = {request["request_id"]: index for index, request in enumerate(requests_data)}
+        last_dependent_positions = list(range(len(requests_data)))
+        atomicity_group_positions = {}
+        for index, request in enumerate(requests_data):
+            for dependency_id in request.get("depends_on", []):
+                if dependency_id in positions:
+                    last_dependent_positions[positions[dependency_id]] = index
+
+            atomicity_group = request.get("atomicity_group")
+            if atomicity_group:
+                if atomicity_group in atomicity_group_positions:
+                    last_dependent_positions[atomicity_group_positions[atomicity_group]] = index
+                atomicity_group_positions[atomicity_group] = index
+
+        chunks = []
+        start = 0
+        while start < len(requests_data):
+            end = start
+            reach = start
+            last_cut = None
+            while end < len(requests_data) and (end - start < self.max_batch_operations or last_cut is None):
+                reach = max(reach, last_dependent_positions[end])
+                end += 1
+                if reach < end:
+                    last_cut = end
+
+            chunks.append(requests_data[start:last_cut])
+            start = last_cut
+
+        return chunks
+
+    @staticmethod
+    def get_retry_requests(requests_data: List[dict], responses: List[dict], retry_ids: set) -> List[dict]:
+        """
+        Returns the requests to send again for the given response ids. Requests that depend on a retried
+        request failed with it, so they are retried too, as are the requests rolled back with it when they
+        are in the same atomicity group. References to requests that succeeded and are not retried are
+        replaced by the location of the entity they created
+        """
+        retry_ids = set(retry_ids)
+        retry_atomicity_groups = {request["atomicity_group"] for request in requests_data if request["request_id"] in retry_ids and request.get("atomicity_group")}
+        for request in requests_data:
+            if request.get("atomicity_group") in retry_atomicity_groups:
+                retry_ids.add(request["request_id"])
+            if any(dependency_id in retry_ids for dependency_id in request.get("depends_on", [])):
+                retry_ids.add(request["request_id"])
+
+        locations = {response.get("id"): DynamicsClient._get_header(response, "Location") for response in responses}
+
+        retry_requests = []
+        for request in requests_data:
+            if request["request_id"] not in retry_ids:
+                continue
+
+            depends_on = request.get("depends_on")
+            if depends_on:
+                request = {**request, "depends_on": [dependency_id for dependency_id in depends_on if dependency_id in retry_ids]}
+                reference = request["url"].split("/", 1)[0]
+                if reference.startswith("$") and reference[1:] not in retry_ids and locations.get(reference[1:]):
+                    request["url"] = locations[reference[1:]] + request["url"][len(reference):]
+
+            retry_requests.append(request)
+
+        return retry_requests
+
+    def _send_batch_request_with_retries(self, requests_data: List[dict], headers: dict, transaction_type: str) -> List[dict]:
+        """
+        Sends the batch request and retries the requests that were throttled. For non atomic batches
+        only the throttled requests are sent again, for atomic batches the whole batch is rolled back
+        so it's sent again entirely
+        """
+        responses = self._send_batch_request(requests_data, headers)
+
+        for attempt in range(self.max_retries):
+            throttled_responses = [response for response in responses if response.get("status") in self.retryable_status_codes]
+            if not throttled_responses:
+                break
+
+            if any(response.get("status") == 429 for response in throttled_responses):
+                self.rate_limiter.on_throttle()
+
+            delay = max(self._get_retry_delay(attempt, DynamicsClient._get_header(response, "Retry-After")) for response in throttled_responses)
+            LOGGER.warning(f"{len(throttled_responses)} batch requests were throttled. Retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+            time.sleep(delay)
+
+            if transaction_type == "atomic":
+                responses = self._send_batch_request(requests_data, headers)
+                continue
+
+            throttled_ids = {response.get("id") for response in throttled_responses}
+            retried_responses = self._send_batch_request(self.get_retry_requests(requests_data, responses, throttled_ids), headers)
+            retried_responses_by_id = {response.get("id"): response for response in retried_responses}
+            responses = [retried_responses_by_id.get(response.get("id"), response) for response in responses]
+
+        return responses
+
+    @staticmethod
+    def is_read_only_batch(requests_data: List[dict]) -> bool:
+        """Batches with only GET requests can be sent again safely after a connection error"""
+        return all(request["method"] == "GET" for request in requests_data)
+
+    @staticmethod
+    def _get_header(response: dict, header_name: str) -> Optional[str]:
+        """Headers of batch responses are not case insensitive, so we look for them ignoring the case"""
+        for name, value in (response.get("headers") or {}).items():
+            if name.lower() == header_name.lower():
+                return value
+        return None
+
+    def _send_batch_request(self, requests_data: List[dict], headers: dict) -> List[dict]:
+        request_data = self.build_batch_request_data(requests_data)
+        response = self._make_request("$batch", "POST", data=request_data, headers=headers, retry_connection_errors=self.is_read_only_batch(requests_data))
+        responses = self.codec.loads(response.content).get("responses", [])
+        return responses
+
+    def _stream_batch_request(self, requests_data: List[dict], headers: dict) -> Iterator[dict]:
+        """Same as _send_batch_request, but the responses are parsed and yielded one at a time as the body is read"""
+        request_data = self.build_batch_request_data(requests_data)
+        response = self._make_request("$batch", "POST", data=request_data, headers=headers, stream=True, retry_connection_errors=self.is_read_only_batch(requests_data))
+
+        try:
+            if response.status_code >= 400:
+                # errors of the whole batch are small, they don't have a responses list
+                body = response.json() if response.content else {}
+                yield from (body.get("responses", []) if isinstance(body, dict) else [])
+                return
+
+            response.raw.decode_content = True
+            yield from ijson.items(response.raw, "responses.item", use_float=True)
+        finally:
+            response.close()
+
+    def iter_batch_responses(self, requests_data: List[dict]) -> Iterator[dict]:
+        """
+        Same as make_batch_request for non atomic batches, but the responses are yielded as they are parsed
+        so the raw body and the other responses are not held in memory. Each response is still parsed
+        whole, with all the entities of its page, and get_entities still collects all the pages in one list.
+        Throttled responses are retried once the rest of the batch is read
+        """
+        headers = self.get_batch_headers("non_atomic")
+        requests_data = self.assign_request_ids(requests_data)
+
+        for requests_chunk in self.chunk_batch_requests(requests_data, "non_atomic"):
+            for attempt in range(self.max_retries + 1):
+                throttled_responses = []
+                for response in self._stream_batch_request(requests_chunk, headers):
+                    if response.get("status") in self.retryable_status_codes and attempt < self.max_retries:
+                        throttled_responses.append(response)
+                        continue
+                    yield response
+
+                if not throttled_responses:
+                    break
+
+                if any(response.get("status") == 429 for response in throttled_responses):
+                    self.rate_limiter.on_throttle()
+
+                delay = max(self._get_retry_delay(attempt, DynamicsClient._get_header(response, "Retry-After")) for response in throttled_responses)
+                LOGGER.warning(f"{len(throttled_responses)} batch requests were throttled. Retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                time.sleep(delay)
+
+                throttled_ids = {response.get("id") for response in throttled_responses}
+                requests_chunk = self.get_retry_requests(requests_chunk, throttled_responses, throttled_ids)
+
+    @staticmethod
+    def build_batch_request_data(requests_data: List[dict]) -> dict:
         request_data = {"requests": []}
 
         for request in requests_data:
@@ -117,24 +467,104 @@ class DynamicsClient:
             request_id = request.get("request_id")
             if request_id:
                 data["id"] = request_id
+            # the request is only executed after the requests it depends on, it can reference
+            # the entity created by one of them in its url with $<request id>
+            depends_on = request.get("depends_on")
+            if depends_on:
+                data["dependsOn"] = depends_on
+            # the requests of an atomicity group are rolled back together if one of them fails
+            atomicity_group = request.get("atomicity_group")
+            if atomicity_group:
+                data["atomicityGroup"] = atomicity_group
 
             request_data["requests"].append(data)
 
-        response = self._make_request("$batch", "POST", data=request_data, headers=headers)
-        responses = response.json().get("responses", [])
-        return responses
+        return request_data
 
-    def get_entities(self, record_type: str, url_params: Optional[dict] = {}, filters: Optional[Dict[str, List]] = {}, expand: str = None):
-        """"Uses batch request to get data because the url can be of any length, allowing for long filters"""
+    def get_batch_pages(self, requests_data: List[dict]) -> Iterator[Tuple[str, dict]]:
+        """
+        Performs GET requests using batch requests and yields every page of every response as
+        (request_id, response). When a response has @odata.nextLink the next page is requested in
+        a further batch request, together with the next pages of the other responses
+        """
+        pending_requests = self.prepare_page_requests(requests_data)
+
+        while pending_requests:
+            if self.stream_batch_responses:
+                responses = self.iter_batch_responses(pending_requests)
+            else:
+                responses = self.make_batch_request(pending_requests)
+
+            # only the next links are kept, the pages are released once the caller consumed them
+            next_links = []
+            for response in responses:
+                body = response.get("body")
+                if isinstance(body, dict) and body.get("@odata.nextLink"):
+                    next_links.append({"id": response.get("id"), "body": {"@odata.nextLink": body["@odata.nextLink"]}})
+                yield response.get("id"), response
+
+            pending_requests = self.get_next_page_requests(pending_requests, next_links)
+
+    def prepare_page_requests(self, requests_data: List[dict]) -> List[dict]:
+        """Sets the request ids and the page size preference of the GET requests"""
+        page_size = self.config.get("page_size")
+
+        page_requests = []
+        for index, request in enumerate(requests_data):
+            request = {**request, "request_id": request.get("request_id") or str(index)}
+            if page_size:
+                request["headers"] = {**request.get("headers", {}), "Prefer": f"odata.maxpagesize={page_size}"}
+            page_requests.append(request)
+
+        return page_requests
+
+    def get_next_page_requests(self, requests_data: List[dict], responses: List[dict]) -> List[dict]:
+        """Builds the requests for the next pages of the responses that have @odata.nextLink"""
+        requests_by_id = {request["request_id"]: request for request in requests_data}
+
+        next_page_requests = []
+        for response in responses:
+            body = response.get("body")
+            next_link = body.get("@odata.nextLink") if isinstance(body, dict) else None
+            if next_link and response.get("id") in requests_by_id:
+                next_page_requests.append({**requests_by_id[response["id"]], "url": self._get_relative_url(next_link)})
+
+        return next_page_requests
+
+    def _get_relative_url(self, url: str) -> str:
+        """nextLinks are absolute urls, batch requests urls are relative to the service root"""
+        if url.startswith(self.url):
+            return url[len(self.url):]
+        return url
+
+    def get_entity_pages(self, record_type: str, url_params: Optional[dict] = {}, filters: Optional[Dict[str, List]] = {}, expand: str = None) -> Iterator[Tuple[bool, Optional[str], List[dict]]]:
+        """
+        Same as get_entities, but yields the entities one page at a time so callers don't need
+        to hold large result sets in memory
+        """
+        requests_data = self.build_get_entities_requests(record_type, url_params, filters, expand)
+
+        for _, response in self.get_batch_pages(requests_data):
+            success, error_message = self._validate_batch_response(response)
+            if not success:
+                yield success, error_message, []
+                return
+            yield True, None, response.get("body", {}).get("value", [])
+
+    def build_get_entities_requests(self, record_type: str, url_params: Optional[dict] = {}, filters: Optional[Dict[str, List]] = {}, expand: str = None) -> List[dict]:
         endpoint = self.ref_request_endpoints[record_type].format(**url_params)
         entity_filters = []
 
-        if expand:
-                expand = f"$expand={expand}"
+        query_options = "&".join(self.get_query_options(record_type, expand))
         
         for filter_field_name, filter_values in filters.items():
             if filter_values:
-                entity_filters.append([f"{filter_field_name} eq {filter_value}" for filter_value in filter_values])
+                # remove duplicated values keeping their order
+                filter_values = list(dict.fromkeys(filter_values))
+                entity_filters += self._chunk_filter_expressions(
+                    f"{endpoint}?{query_options}",
+                    [f"{filter_field_name} eq {filter_value}" for filter_value in filter_values]
+                )
 
         if not entity_filters:
             entity_filters = [[]]
@@ -147,7 +577,7 @@ class DynamicsClient:
                 entity_filter = f"$filter={' or '.join(entity_filter)}"
 
             request_url = endpoint
-            query_string = "&".join(filter(None, [expand, entity_filter]))
+            query_string = "&".join(filter(None, [query_options, entity_filter]))
             if query_string:
                 request_url += f"?{query_string}"
 
@@ -156,104 +586,352 @@ class DynamicsClient:
                 "method": "GET",
             })
 
-        batch_responses = self.make_batch_request(requests_data)
-        
+        return requests_data
+
+    def get_query_options(self, record_type: str, expand: Optional[str] = None) -> List[str]:
+        """Returns the $select and $expand query options to get the entities of record_type"""
+        query_options = []
+
+        select = self.ref_request_select.get(record_type) if self.config.get("select_fields") else None
+        if select:
+            query_options.append(f"$select={','.join(select)}")
+
+        if expand:
+            query_options.append(f"$expand={self.select_expand(expand)}")
+
+        return query_options
+
+    def select_expand(self, expand: str) -> str:
+        """
+        Adds the $select of each navigation property of the $expand option, including the nested ones.
+        For example "dimensionSetLines,purchaseInvoiceLines($expand=dimensionSetLines)" becomes
+        "dimensionSetLines($select=id,valueId),purchaseInvoiceLines($select=...;$expand=dimensionSetLines($select=id,valueId))"
+        """
+        if not self.config.get("select_fields"):
+            return expand
+
+        expand_items = []
+        for expand_item in DynamicsClient._split_query_option(expand, ","):
+            navigation_property, _, nested_options = expand_item.partition("(")
+            navigation_property = navigation_property.strip()
+            nested_options = DynamicsClient._split_query_option(nested_options[:-1], ";") if nested_options else []
+
+            options = []
+            select = self.ref_request_select.get(navigation_property)
+            if select and not any(option.startswith("$select=") for option in nested_options):
+                options.append(f"$select={','.join(select)}")
+            for option in nested_options:
+                if option.startswith("$expand="):
+                    option = f"$expand={self.select_expand(option[len('$expand='):])}"
+                options.append(option)
+
+            expand_items.append(f"{navigation_property}({';'.join(options)})" if options else navigation_property)
+
+        return ",".join(expand_items)
+
+    @staticmethod
+    def _split_query_option(value: str, separator: str) -> List[str]:
+        """Splits the value by the separator, ignoring the separators inside parentheses"""
+        parts = []
+        depth = 0
+        part = ""
+        for char in value:
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+            if char == separator and depth == 0:
+                parts.append(part.strip())
+                part = ""
+                continue
+            part += char
+
+        if part.strip():
+            parts.append(part.strip())
+
+        return parts
+
+    def _chunk_filter_expressions(self, endpoint: str, filter_expressions: List[str]) -> List[List[str]]:
+        """
+        Splits the filter expressions in groups so the url of each request, with the expressions
+        joined by 'or', stays under the max url length accepted by Dynamics
+        """
+        max_url_length = int(self.config.get("max_url_length", 2048))
+        # leave room for the endpoint, $expand and the $filter option itself
+        max_filter_length = max_url_length - len(quote(endpoint)) - 512
+
+        chunks = []
+        chunk = []
+        chunk_length = 0
+        for filter_expression in filter_expressions:
+            expression_length = len(quote(f" or {filter_expression}"))
+            if chunk and chunk_length + expression_length > max_filter_length:
+                chunks.append(chunk)
+                chunk = []
+                chunk_length = 0
+            chunk.append(filter_expression)
+            chunk_length += expression_length
+
+        if chunk:
+            chunks.append(chunk)
+
+        return chunks
+
+    def get_entities(self, record_type: str, url_params: Optional[dict] = {}, filters: Optional[Dict[str, List]] = {}, expand: str = None):
+        """"Uses batch request to get data because the url can be of any length, allowing for long filters"""
         entities = []
 
-        for response in batch_responses:
+        for success, error_message, page_entities in self.get_entity_pages(record_type, url_params, filters, expand):
+            if not success:
+                return success, error_message, entities
+            entities += page_entities
+        
+        return True, None, entities
+
+    def get_entities_by_ids(self, record_type: str, ids_by_url_params: List[Tuple[dict, List[str]]], expand: str = None) -> Tuple[bool, Optional[str], List[dict]]:
+        """
+        Gets entities by id from several companies (or parents) at once, the requests for all of them
+        are sent together in the same batch requests
+        """
+        requests_data = []
+        for url_params, ids in ids_by_url_params:
+            requests_data += self.build_get_entities_requests(record_type, url_params, {"id": ids}, expand)
+
+        entities = []
+        for _, response in self.get_batch_pages(requests_data):
             success, error_message = self._validate_batch_response(response)
             if not success:
                 return success, error_message, entities
             entities += response.get("body", {}).get("value", [])
-        
+
         return True, None, entities
 
-    def get_companies(self):
+    def get_companies(self, cached_companies: Optional[List[Dict]] = None, load_reference_data: bool = True):
+        """
+        Gets all the companies and their reference data. All the reference data requests
+        for all the companies are packed in as few batch requests as possible and each
+        response is mapped back to its company by the request id
+
+        cached_companies: companies loaded in a previous run. For the incremental collections of
+        these companies only the entities modified since the cached data are fetched and merged
+        load_reference_data: if False only the companies are returned, their reference data
+        can be loaded later with load_companies_reference_data
+        """
         _, _, companies = self.get_entities("Companies")
+        cached_companies_by_id = {company["id"]: company for company in cached_companies or []}
 
+        if load_reference_data:
+            self.load_companies_reference_data(companies, cached_companies_by_id)
+
+        return True, None, companies
+
+    def load_companies_reference_data(self, companies: List[Dict], cached_companies_by_id: Optional[Dict[str, Dict]] = None, collections: Optional[List[str]] = None):
+        """
+        Loads the reference data of the given companies into them, the requests for all the
+        companies are sent together. By default all the company_reference_collections are loaded
+        """
+        cached_companies_by_id = cached_companies_by_id or {}
+        reference_collections = {
+            field_name: collection for field_name, collection in self.company_reference_collections.items()
+            if collections is None or field_name in collections
+        }
+
+        requests_data = []
         for company in companies:
             url_params = {"companyId": company["id"]}
+            cached_company = cached_companies_by_id.get(company["id"])
+            for field_name, collection in reference_collections.items():
+                endpoint = self.ref_request_endpoints[collection["record_type"]].format(**url_params)
+                query_options = self.get_query_options(collection["record_type"], collection.get("expand"))
 
-            _, _, currencies = self.get_entities("Currencies", url_params)
-            company["currencies"] = currencies
-            
-            _, _, payment_methods = self.get_entities("PaymentMethods", url_params)
-            company["paymentMethods"] = payment_methods
+                if cached_company and collection["incremental"]:
+                    last_modified = DynamicsClient.get_last_modified_date_time(cached_company.get(field_name, []))
+                    if last_modified:
+                        query_options.append(f"$filter=lastModifiedDateTime ge {last_modified}")
 
-            _, _, dimensions = self.get_entities("Dimensions", url_params, expand="dimensionValues")
-            company["dimensions"] = dimensions
+                requests_data.append({
+                    "url": f"{endpoint}?{'&'.join(query_options)}" if query_options else endpoint,
+                    "method": "GET",
+                    "request_id": f"{company['id']}_{field_name}"
+                })
 
-            _, _, accounts = self.get_entities("Accounts", url_params)
-            company["accounts"] = accounts
+        pages_by_id = {}
+        for request_id, response in self.get_batch_pages(requests_data):
+            pages_by_id.setdefault(request_id, []).append(response)
 
-            _, _, locations = self.get_entities("Locations", url_params)
-            company["locations"] = locations
+        for company in companies:
+            cached_company = cached_companies_by_id.get(company["id"])
+            for field_name in reference_collections:
+                # if the request fails we keep whatever was cached for this company
+                company[field_name] = cached_company.get(field_name, []) if cached_company else []
 
-        return True, None, companies
-    
-    def get_existing_entities_for_records(self, companies_reference_data: List[Dict], record_type: str, records: List[Dict], filter_mappings: List[Dict], expand: Optional[str] = None) -> Dict[str, List]:
-        """Maps records to companies and returns a list of entities based on 'records'"""
-        
-        # we need to map the company to query the existing customers
-        company_entities_mapping = {}
+                pages = pages_by_id.get(f"{company['id']}_{field_name}")
+                if not pages:
+                    LOGGER.warning(f"Missing response when getting {field_name} for companyId={company['id']}")
+                    continue
 
-        for record in records:
-            company = BaseMapper.get_company_from_record(companies_reference_data, record)
-            if not company:
-                continue
+                entities = []
+                for page in pages:
+                    success, error_message = self._validate_batch_response(page)
+                    if not success:
+                        break
+                    entities += page.get("body", {}).get("value", [])
 
-            if company["id"] not in company_entities_mapping.keys():
-                company_entities_mapping[company["id"]] = {}
-            
-            for filter_mapping in filter_mappings:
-                filter_field_from = filter_mapping["field_from"]
-                filter_field_to = filter_mapping["field_to"]
-                filter_field_should_quote = filter_mapping["should_quote"]
+                if not success:
+                    LOGGER.warning(f"Failed to get {field_name} for companyId={company['id']}: {error_message}")
+                    continue
 
-                if filter_field_to not in company_entities_mapping[company["id"]]:
-                    company_entities_mapping[company["id"]][filter_field_to] = []
+                if cached_company and reference_collections[field_name]["incremental"]:
+                    entities = DynamicsClient.merge_entities(cached_company.get(field_name, []), entities)
 
-                rec_value = record.get(filter_field_from)
-                if rec_value:
-                    # escape odata string
-                    rec_value = DynamicsClient.escape_odata_string(rec_value)
-                    if filter_field_should_quote:
-                        rec_value = f"'{rec_value}'"
-                    company_entities_mapping[company["id"]][filter_field_to].append(rec_value)
+                company[field_name] = entities
+
+    @staticmethod
+    def get_last_modified_date_time(entities: List[Dict]) -> Optional[str]:
+        """Returns the most recent lastModifiedDateTime of the given entities"""
+        return max((entity["lastModifiedDateTime"] for entity in entities if entity.get("lastModifiedDateTime")), default=None)
+
+    @staticmethod
+    def merge_entities(entities: List[Dict], modified_entities: List[Dict]) -> List[Dict]:
+        """Merges modified_entities into entities by id, keeping the original order"""
+        merged_entities = {entity["id"]: entity for entity in entities}
+        for modified_entity in modified_entities:
+            merged_entities[modified_entity["id"]] = modified_entity
+
+        return list(merged_entities.values())
+
+    def get_existing_entities_for_records(self, companies_reference_data: List[Dict], record_type: str, records: List[Dict], filter_mappings: List[Dict], expand: Optional[str] = None, entity_cache: Optional[EntityCache] = None) -> Dict[str, List]:
+        """
+        Maps records to companies and returns a list of entities based on 'records'.
+        With an entity_cache only the filter values missing from it are queried
+        """
+        company_entities_mapping = DynamicsClient.map_records_filters_to_companies(companies_reference_data, records, filter_mappings)
 
         existing_company_entities = {}
         # make requests to get existing entities for each company from Dynamics
         for company_id in company_entities_mapping:
             url_params = { "companyId": company_id }
-            
+            filters = company_entities_mapping[company_id]
+
+            cached_entities = []
+            if entity_cache:
+                filters, cached_entities = DynamicsClient.split_cached_filters(entity_cache, record_type, company_id, filters, filter_mappings, expand)
+
             has_filters_to_apply = False
-            for filter_values in company_entities_mapping[company_id].values():
+            for filter_values in filters.values():
                 if filter_values:
                     has_filters_to_apply = True
 
             entities = []
             if has_filters_to_apply:
-                _, _, entities = self.get_entities(
+                success, _, entities = self.get_entities(
                     record_type,
                     url_params=url_params,
-                    filters=company_entities_mapping[company_id],
+                    filters=filters,
                     expand=expand
                 )
+                if entity_cache and success:
+                    DynamicsClient.cache_filters_entities(entity_cache, record_type, company_id, filters, filter_mappings, entities, expand)
+
+            if cached_entities:
+                # entities matching cached and queried filter values are only returned once
+                queried_ids = {entity.get("id") for entity in entities}
+                entities = entities + [entity for entity in cached_entities if entity["id"] not in queried_ids]
 
             if company_id not in existing_company_entities.keys():
                 existing_company_entities[company_id] = []
             existing_company_entities[company_id] += entities
 
         return existing_company_entities
-    
+
+    @staticmethod
+    def split_cached_filters(entity_cache: EntityCache, record_type: str, company_id: str, filters: Dict[str, List], filter_mappings: List[Dict], expand: Optional[str] = None) -> Tuple[Dict[str, List], List[dict]]:
+        """Returns the filter values missing from the entity cache and the cached entities matching the other filter values"""
+        should_quote = {filter_mapping["field_to"]: filter_mapping["should_quote"] for filter_mapping in filter_mappings}
+
+        missing_filters = {}
+        cached_entities = {}
+        for field, values in filters.items():
+            missing_filters[field] = []
+            for value in values:
+                entities = []
+                for entity_id in entity_cache.get_filter_ids(record_type, company_id, field, value) or []:
+                    entity = entity_cache.get_entity(record_type, company_id, entity_id, expand)
+                    # the entity could have been updated since it matched the filter value
+                    if entity is None or DynamicsClient.format_filter_value(entity.get(field), should_quote[field]) != value:
+                        entities = []
+                        break
+                    entities.append(entity)
+
+                if not entities:
+                    missing_filters[field].append(value)
+                for entity in entities:
+                    cached_entities[entity["id"]] = entity
+
+        return missing_filters, list(cached_entities.values())
+
+    @staticmethod
+    def cache_filters_entities(entity_cache: EntityCache, record_type: str, company_id: str, filters: Dict[str, List], filter_mappings: List[Dict], entities: List[dict], expand: Optional[str] = None):
+        """Caches the entities queried and the ids of the entities matching each filter value"""
+        should_quote = {filter_mapping["field_to"]: filter_mapping["should_quote"] for filter_mapping in filter_mappings}
+        entity_cache.put_entities(record_type, company_id, entities, expand)
+
+        for field, values in filters.items():
+            entities_by_value = {}
+            for entity in entities:
+                if entity.get(field) is not None and entity.get("id") is not None:
+                    entities_by_value.setdefault(DynamicsClient.format_filter_value(entity[field], should_quote[field]), []).append(entity["id"])
+
+            for value in set(values):
+                if value in entities_by_value:
+                    entity_cache.put_filter_ids(record_type, company_id, field, value, entities_by_value[value])
+
+    @staticmethod
+    def map_records_filters_to_companies(companies_reference_data: List[Dict], records: List[Dict], filter_mappings: List[Dict]) -> Dict[str, Dict[str, List]]:
+        """Maps the records filter values to the company of each record, used to query existing entities per company"""
+        # we need to map the company to query the existing customers
+        company_entities_mapping = {}
+        entity_index_cache = EntityIndexCache()
+
+        for record in records:
+            company = BaseMapper.get_company_from_record(companies_reference_data, record, entity_index_cache)
+            if not company:
+                continue
+
+            if company["id"] not in company_entities_mapping.keys():
+                company_entities_mapping[company["id"]] = {}
+            
+            for filter_mapping in filter_mappings:
+                filter_field_from = filter_mapping["field_from"]
+                filter_field_to = filter_mapping["field_to"]
+                filter_field_should_quote = filter_mapping["should_quote"]
+
+                if filter_field_to not in company_entities_mapping[company["id"]]:
+                    company_entities_mapping[company["id"]][filter_field_to] = []
+
+                rec_value = record.get(filter_field_from)
+                if rec_value:
+                    company_entities_mapping[company["id"]][filter_field_to].append(DynamicsClient.format_filter_value(rec_value, filter_field_should_quote))
+
+        return company_entities_mapping
+
+    @staticmethod
+    def format_filter_value(value, should_quote: bool) -> str:
+        # escape odata string
+        value = DynamicsClient.escape_odata_string(value)
+        if should_quote:
+            value = f"'{value}'"
+        return value
+
     def get_existing_bill_payments_for_records(self, companies_reference_data: List[Dict], company_payment_journals: Dict[str, List], records: List[Dict], filter_mappings: List[Dict]) -> Dict[str, List]:
         """Maps records to companies and returns a list of entities based on 'records'"""
         
         # we need to map the company to query the existing entities
         company_entities_mapping = {}
+        entity_index_cache = EntityIndexCache()
 
         for record in records:
-            company = BaseMapper.get_company_from_record(companies_reference_data, record)
+            company = BaseMapper.get_company_from_record(companies_reference_data, record, entity_index_cache)
             if not company:
                 continue
 
@@ -322,6 +1000,16 @@ class DynamicsClient:
         """
         Create the requests for upserting dimension set lines for a given entity
         """
+        endpoint = DynamicsClient.ref_request_endpoints[record_type]
+        endpoint = endpoint.format(companyId=company_id, entityId=entity_id, parentId=parentId)
+
+        return DynamicsClient.create_endpoint_dimension_set_lines_requests(endpoint, dimensions_set_lines, existing_dimension_set_lines)
+
+    @staticmethod
+    def create_endpoint_dimension_set_lines_requests(endpoint: str, dimensions_set_lines: List[dict], existing_dimension_set_lines: Optional[List[dict]]=[]):
+        """
+        Create the requests for upserting dimension set lines in the given dimensionSetLines endpoint
+        """
         requests = []
 
         for dimension_set_line in dimensions_set_lines:
@@ -330,9 +1018,6 @@ class DynamicsClient:
 
             found_existing_dimension = next((existing_dimension for existing_dimension in existing_dimension_set_lines if existing_dimension["id"] == dimension_id), None)
 
-            endpoint = DynamicsClient.ref_request_endpoints[record_type]
-            endpoint = endpoint.format(companyId=company_id, entityId=entity_id, parentId=parentId)
-            
             if not found_existing_dimension:
                 request_params = {
                     "url": endpoint,
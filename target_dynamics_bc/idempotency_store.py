@@ -0,0 +1,94 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+import singer
+
+LOGGER = singer.get_logger()
+
+class IdempotencyStore:
+    """
+    SQLite store in the snapshot directory that maps the hash of every record successfully
+    applied to Dynamics to the Dynamics id, so records replayed in later job runs can be skipped
+    before being mapped or sent to Dynamics.
+
+    Entries expire after ttl seconds, expired entries are deleted by compact.
+
+    Entries are kept in the open transaction until commit is called once per batch,
+    instead of a commit (and fsync) per record
+    """
+    file_name = "dynamics-bc-idempotency.db"
+
+    # the file is only vacuumed when the expired entries were at least this part of the entries,
+    # otherwise sqlite reuses their free pages
+    vacuum_min_deleted_ratio = 0.25
+
+    def __init__(self, snapshot_directory: str, environment: str, ttl: int) -> None:
+        self.path = os.path.join(snapshot_directory, self.file_name)
+        self.environment = environment
+        self.ttl = ttl
+
+        # records can be upserted by several worker threads
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS applied_records (
+                environment TEXT NOT NULL,
+                stream TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                entity_id TEXT,
+                outcome TEXT NOT NULL,
+                applied_at REAL NOT NULL,
+                PRIMARY KEY (environment, stream, hash)
+            )
+            """
+        )
+        self._connection.commit()
+
+    def get(self, stream: str, record_hash: str) -> Optional[Dict]:
+        """Returns the applied record for the hash if it didn't expire"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT entity_id, outcome, applied_at FROM applied_records WHERE environment = ? AND stream = ? AND hash = ? AND applied_at > ?",
+                (self.environment, stream, record_hash, time.time() - self.ttl)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        entity_id, outcome, applied_at = row
+        return {"id": entity_id, "outcome": outcome, "applied_at": applied_at}
+
+    def put(self, stream: str, record_hash: str, entity_id: Optional[str], outcome: str):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO applied_records (environment, stream, hash, entity_id, outcome, applied_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.environment, stream, record_hash, entity_id, outcome, time.time())
+            )
+
+    def commit(self):
+        """Commits the entries put since the last commit"""
+        with self._lock:
+            self._connection.commit()
+
+    def compact(self):
+        """Deletes the expired entries, the space is reclaimed if many entries were deleted"""
+        with self._lock:
+            total = self._connection.execute("SELECT COUNT(*) FROM applied_records").fetchone()[0]
+            deleted = self._connection.execute(
+                "DELETE FROM applied_records WHERE applied_at <= ?",
+                (time.time() - self.ttl,)
+            ).rowcount
+            self._connection.commit()
+            if deleted and deleted >= total * self.vacuum_min_deleted_ratio:
+                self._connection.execute("VACUUM")
+
+        LOGGER.info(f"Compacted idempotency store at {self.path}, {deleted} expired entries deleted")
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
@@ -0,0 +1,64 @@
+import json
+from typing import Any, Optional
+
+import singer
+
+from target_hotglue.common import HGJSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+LOGGER = singer.get_logger()
+
+class JSONCodec:
+    """
+    Serializes with the standard json module and HGJSONEncoder. The output is the same as
+    json.dumps(data, cls=HGJSONEncoder)
+    """
+    name = "json"
+
+    def dumps(self, data: Any) -> bytes:
+        return json.dumps(data, cls=HGJSONEncoder).encode()
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+class OrjsonCodec(JSONCodec):
+    """
+    Serializes with orjson. Datetimes, dates, Decimals and any other type orjson doesn't serialize
+    natively are converted by HGJSONEncoder, the same way the json module does.
+    The output is compact and not ascii escaped, so it's not byte for byte the same as JSONCodec
+    """
+    name = "orjson"
+
+    def __init__(self) -> None:
+        self._encoder = HGJSONEncoder()
+        # datetimes are passed through so they are formatted by HGJSONEncoder too
+        self._options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, data: Any) -> bytes:
+        try:
+            return orjson.dumps(data, default=self._encoder.default, option=self._options)
+        except orjson.JSONEncodeError:
+            # integers over 64 bits and the values HGJSONEncoder can't serialize are left to the json module
+            return super().dumps(data)
+
+    def loads(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+def get_codec(name: Optional[str] = None) -> JSONCodec:
+    """
+    Returns the codec by name ("json" or "orjson"). By default orjson is used when it's installed,
+    otherwise the json module
+    """
+    if name == "json":
+        return JSONCodec()
+
+    if orjson is None:
+        if name == "orjson":
+            LOGGER.warning("orjson is not installed. Install target-dynamics-bc[fast-json]. Using the json module")
+        return JSONCodec()
+
+    return OrjsonCodec()
@@ -1,7 +1,10 @@
 import datetime
-from typing import Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from target_dynamics_bc.utils import ReferenceData, CompanyNotFound, InvalidDimensionValue, InvalidInputError, RecordNotFound, DimensionDefinitionNotFound
+from target_dynamics_bc.utils import EntityIndexCache, ReferenceData, CompanyNotFound, InvalidDimensionValue, InvalidInputError, RecordNotFound, DimensionDefinitionNotFound
+
+def _datetime_to_date(value: datetime.datetime) -> str:
+    return value.isoformat()[:10]
 
 class BaseMapper:
     """A base class responsible for mapping a record ingested in the unified schema format to a payload for NetSuite"""
@@ -20,26 +23,43 @@ class BaseMapper:
         self.existing_record = self._find_existing_record(self.reference_data.get(self.sink.name, {}))
 
     @staticmethod
-    def get_company_from_record(company_list: List[dict], record: dict) -> dict:
-        company = None
-
-        subsidiary_id = record.get("subsidiaryId")
-        if subsidiary_id:
-            company = next(
-                (company for company in company_list
-                if company["id"] == subsidiary_id),
-                None
-            )
+    def get_company_from_record(company_list: List[dict], record: dict, entity_index_cache: Optional[EntityIndexCache] = None) -> dict:
+        entity_index_cache = entity_index_cache or EntityIndexCache()
+        return BaseMapper.find_entity(
+            entity_index_cache,
+            company_list,
+            [("id", record.get("subsidiaryId")), ("name", record.get("subsidiaryName"))]
+        )
 
-        subsidiary_name = record.get("subsidiaryName")
-        if subsidiary_name and company is None:
-            company = next(
-                (company for company in company_list
-                if company["name"] == subsidiary_name),
-                None
-            )
+    @staticmethod
+    def find_entity(entity_index_cache: EntityIndexCache, entities: List[dict], lookups: List[Tuple[str, Any]]) -> Optional[dict]:
+        """
+        Finds an entity by trying each (field, value) lookup in order, for example by id, then by
+        code and then by displayName. Lookups without a value are skipped
+        """
+        index = entity_index_cache.get_index(entities, tuple(dict.fromkeys(field for field, _ in lookups)))
 
-        return company
+        for field, value in lookups:
+            if value:
+                found_entity = index.get(field, value)
+                if found_entity:
+                    return found_entity
+
+        return None
+
+    def _find_entity(self, entities: List[dict], lookups: List[Tuple[str, Any]], entity_type: Optional[str] = None) -> Optional[dict]:
+        """
+        When entity_type is given the lookup is memoized for the batch by
+        (entity_type, company id, lookups), so the same reference is resolved only once
+        """
+        if entity_type is None:
+            return BaseMapper.find_entity(self.sink.entity_index_cache, entities, lookups)
+
+        company_id = self.company["id"] if self.company else None
+        return self.sink.lookup_cache.get_or_resolve(
+            (entity_type, company_id, tuple(lookups)),
+            lambda: BaseMapper.find_entity(self.sink.entity_index_cache, entities, lookups)
+        )
 
     def _find_existing_record(self, reference_list):
         """Finds an existing record in the reference data by matching internal.
@@ -52,11 +72,7 @@ class BaseMapper:
         for existing_record_pk_mapping in self.existing_record_pk_mappings:
             record_id = self.record.get(existing_record_pk_mapping["record_field"])
             if record_id:
-                found_record = next(
-                    (dynamics_record for dynamics_record in existing_entities_in_dynamics
-                    if dynamics_record[existing_record_pk_mapping["dynamics_field"]] == record_id),
-                    None
-                )
+                found_record = self._find_entity(existing_entities_in_dynamics, [(existing_record_pk_mapping["dynamics_field"], record_id)])
                 if existing_record_pk_mapping["required_if_present"] and found_record is None:
                     raise RecordNotFound(f"Record {existing_record_pk_mapping['record_field']}={record_id} not found Dynamics. Skipping it")
                 
@@ -65,6 +81,37 @@ class BaseMapper:
         
         return None
 
+    @staticmethod
+    def normalize_value(value: Any) -> Any:
+        # Dynamics returns empty strings for fields that are not set and "_x0020_" for blank option values
+        return "" if value in (None, "", " ", "_x0020_") else value
+
+    def drop_unchanged(self, payload: dict) -> bool:
+        """
+        Compares the mapped payload with the existing record. The defaultDimensions that didn't change
+        are removed from the payload, returns True if there is nothing to update in Dynamics
+        """
+        if not self.existing_record:
+            return False
+
+        existing_default_dimensions = {
+            existing_default_dimension["dimensionId"]: existing_default_dimension.get("dimensionValueId")
+            for existing_default_dimension in self.existing_record.get("defaultDimensions", [])
+        }
+        default_dimensions = [
+            default_dimension for default_dimension in payload.pop("defaultDimensions", [])
+            if existing_default_dimensions.get(default_dimension["dimensionId"]) != default_dimension["dimensionValueId"]
+        ]
+        if default_dimensions:
+            payload["defaultDimensions"] = default_dimensions
+            return False
+
+        return all(
+            BaseMapper.normalize_value(value) == BaseMapper.normalize_value(self.existing_record.get(key))
+            for key, value in payload.items()
+            if key != "id"
+        )
+
     def _map_internal_id(self):
         if self.existing_record:
             return { "id": self.existing_record["id"]}
@@ -120,31 +167,12 @@ class BaseMapper:
         """Extracts currency to Dynamics format."""
         currency_info = {}
 
-        found_currency = None
-
-        currency_id = self.record.get("currencyId")
-        if currency_id:
-            found_currency = next(
-                (currency for currency in self.company["currencies"]
-                if currency["id"] == currency_id),
-                None
-            )
-
         currency_code = self.record.get("currency")
-        if currency_code and not found_currency:
-            found_currency = next(
-                (currency for currency in self.company["currencies"]
-                if currency["code"] == currency_code),
-                None
-            )
-
-        currency_name = self.record.get("currencyName")
-        if currency_name and not found_currency:
-            found_currency = next(
-                (currency for currency in self.company["currencies"]
-                if currency["displayName"] == currency_name),
-                None
-            )
+        found_currency = self._find_entity(
+            self.company["currencies"],
+            [("id", self.record.get("currencyId")), ("code", currency_code), ("displayName", self.record.get("currencyName"))],
+            entity_type="currencies"
+        )
 
         if found_currency:
             currency_info = {
@@ -158,7 +186,12 @@ class BaseMapper:
         return currency_info
 
     def _map_company(self):
-        return BaseMapper.get_company_from_record(self.reference_data.get("companies", []), self.record)
+        subsidiary_id = self.record.get("subsidiaryId")
+        subsidiary_name = self.record.get("subsidiaryName")
+        return self.sink.lookup_cache.get_or_resolve(
+            ("companies", None, subsidiary_id, subsidiary_name),
+            lambda: BaseMapper.get_company_from_record(self.reference_data.get("companies", []), self.record, self.sink.entity_index_cache)
+        )
 
     def _validate_company(self):
         if not self.company:
@@ -167,11 +200,14 @@ class BaseMapper:
             raise CompanyNotFound(f"Could not find Company with subsidiaryId={subsidiary_id} / subsidiaryName={subsidiary_name}")
 
     def _get_dimension(self, dimension_id: Optional[str] = None, dimension_code: Optional[str] = None, dimension_display_name: Optional[str] = None):
-        found_dimension = next(
-            (dimension for dimension in self.company["dimensions"]
-                if dimension["id"] == dimension_id or dimension["code"] == dimension_code or dimension["displayName"] == dimension_display_name
-            ),
-            None)
+        def find_dimension():
+            index = self.sink.entity_index_cache.get_index(self.company["dimensions"], ("id", "code", "displayName"))
+            return index.find_first(id=dimension_id, code=dimension_code, displayName=dimension_display_name)
+
+        found_dimension = self.sink.lookup_cache.get_or_resolve(
+            ("dimensions", self.company["id"], dimension_id, dimension_code, dimension_display_name),
+            find_dimension
+        )
         
         if not found_dimension:
             raise DimensionDefinitionNotFound(f"Could not find dimension with id={dimension_id} / code={dimension_code} / displayName={dimension_display_name} for companyId={self.company['id']}")
@@ -180,31 +216,16 @@ class BaseMapper:
 
     def _get_dimension_value(self, dimension: dict, value_id: str, value_code: str, value_display_name: str):
         """Find dimension value by looking for dimension id, code or displayName"""
-        found_dimension_value = next(
-            (dimension_value for dimension_value in dimension.get("dimensionValues", []) if dimension_value["id"] == value_id),
-            None
-        )
-        if found_dimension_value:
-            return found_dimension_value
-        
-        found_dimension_value = next(
-            (dimension_value for dimension_value in dimension.get("dimensionValues", []) if dimension_value["code"] == value_code),
-            None
+        found_dimension_value = self._find_entity(
+            dimension.get("dimensionValues", []),
+            [("id", value_id), ("code", value_code), ("displayName", value_display_name)],
+            entity_type=f"dimensionValues:{dimension['id']}"
         )
-        if found_dimension_value:
-            return found_dimension_value
-        
-        found_dimension_value = next(
-            (dimension_value for dimension_value in dimension.get("dimensionValues", []) if dimension_value["displayName"] == value_display_name),
-            None
-        )
-        if found_dimension_value:
-            return found_dimension_value
 
         if not found_dimension_value:
             raise InvalidDimensionValue(f"Dimension could not find a Dimension Value for dimension {dimension['code']} when looking up dimension value id={value_id} / code={value_code} / displayName={value_display_name}")
 
-        return None
+        return found_dimension_value
 
     def _get_existing_default_dimension(self, dimension_id: str):
         if not self.existing_record:
@@ -343,35 +364,22 @@ class BaseMapper:
 
         return {"dimensionSetLines": dimension_set_lines} if dimension_set_lines else {}
 
+    def _find_vendor(self) -> Optional[dict]:
+        vendors_reference_data = self.reference_data.get("Vendors", {}).get(self.company["id"], [])
+
+        return self._find_entity(
+            vendors_reference_data,
+            [("id", self.record.get("vendorId")), ("number", self.record.get("vendorNumber")), ("displayName", self.record.get("vendorName"))],
+            entity_type="Vendors"
+        )
+
     def _map_vendor(self, required: bool=False):
         vendor_info = {}
 
-        found_vendor = None
-        vendors_reference_data = self.reference_data.get("Vendors", {}).get(self.company["id"], [])
-
         vendor_id = self.record.get("vendorId")
-        if vendor_id:
-            found_vendor = next(
-                (vendor for vendor in vendors_reference_data
-                if vendor["id"] == vendor_id),
-                None
-            )
-
         vendor_number = self.record.get("vendorNumber")
-        if vendor_number and not found_vendor:
-            found_vendor = next(
-                (vendor for vendor in vendors_reference_data
-                if vendor["number"] == vendor_number),
-                None
-            )
-
         vendor_name = self.record.get("vendorName")
-        if vendor_name and not found_vendor:
-            found_vendor = next(
-                (vendor for vendor in vendors_reference_data
-                if vendor["displayName"] == vendor_name),
-                None
-            )
+        found_vendor = self._find_vendor()
 
         if found_vendor:
             vendor_info = {
@@ -390,24 +398,15 @@ class BaseMapper:
     def _map_payment_journal(self, required: bool=False):
         payment_journal_info = {}
 
-        found_journal = None
         payment_journal_reference_data = self.reference_data.get("VendorPaymentJournals", {}).get(self.company["id"], [])
 
         journal_id = self.record.get("journalId")
-        if journal_id:
-            found_journal = next(
-                (journal for journal in payment_journal_reference_data
-                if journal["id"] == journal_id),
-                None
-            )
-
         journal_code = self.record.get("journalExternalId")
-        if journal_code and not found_journal:
-            found_journal = next(
-                (journal for journal in payment_journal_reference_data
-                if journal["code"] == journal_code),
-                None
-            )
+        found_journal = self._find_entity(
+            payment_journal_reference_data,
+            [("id", journal_id), ("code", journal_code)],
+            entity_type="VendorPaymentJournals"
+        )
 
         if found_journal:
             payment_journal_info = {
@@ -426,32 +425,14 @@ class BaseMapper:
     def _map_account(self, required: bool=False):
         account_info = {}
 
-        found_account = None
-        accounts_reference_data = self.company["accounts"]
-
         account_id = self.record.get("accountId")
-        if account_id:
-            found_account = next(
-                (account for account in accounts_reference_data
-                if account["id"] == account_id),
-                None
-            )
-
         account_number = self.record.get("accountNumber")
-        if account_number and not found_account:
-            found_account = next(
-                (account for account in accounts_reference_data
-                if account["number"] == account_number),
-                None
-            )
-
         account_name = self.record.get("accountName")
-        if account_name and not found_account:
-            found_account = next(
-                (account for account in accounts_reference_data
-                if account["displayName"] == account_name),
-                None
-            )
+        found_account = self._find_entity(
+            self.company["accounts"],
+            [("id", account_id), ("number", account_number), ("displayName", account_name)],
+            entity_type="accounts"
+        )
 
         if found_account:
             account_info = {
@@ -466,32 +447,11 @@ class BaseMapper:
     def _map_location(self):
         location_info = {}
 
-        found_location = None
-        locations_reference_data = self.company["locations"]
-
-        location_id = self.record.get("locationId")
-        if location_id:
-            found_location = next(
-                (location for location in locations_reference_data
-                if location["id"] == location_id),
-                None
-            )
-
-        location_external_id = self.record.get("locationNumber")
-        if location_external_id and not found_location:
-            found_location = next(
-                (location for location in locations_reference_data
-                if location["code"] == location_external_id),
-                None
-            )
-
-        location_name = self.record.get("locationName")
-        if location_name and not found_location:
-            found_location = next(
-                (location for location in locations_reference_data
-                if location["displayName"] == location_name),
-                None
-            )
+        found_location = self._find_entity(
+            self.company["locations"],
+            [("id", self.record.get("locationId")), ("code", self.record.get("locationNumber")), ("displayName", self.record.get("locationName"))],
+            entity_type="locations"
+        )
 
         if found_location:
             location_info = {
@@ -500,16 +460,35 @@ class BaseMapper:
 
         return location_info
 
+    @staticmethod
+    def compile_field_mappings(field_mappings: Dict[str, Any]) -> List[Tuple[str, str, Optional[Callable]]]:
+        """
+        Compiles field_mappings into (record key, payload key, datetime converter) steps.
+        List payload keys are fanned out into one step each and get the raw record value,
+        other payload keys get datetimes as isoformat, truncated to the date when the
+        payload key ends with "Date"
+        """
+        plan = []
+        for record_key, payload_key in field_mappings.items():
+            if isinstance(payload_key, list):
+                plan += [(record_key, key, None) for key in payload_key]
+            elif payload_key.endswith("Date"):
+                plan.append((record_key, payload_key, _datetime_to_date))
+            else:
+                plan.append((record_key, payload_key, datetime.datetime.isoformat))
+        return plan
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # the plan is compiled once per mapper class instead of walking field_mappings for every record
+        cls.field_mapping_plan = BaseMapper.compile_field_mappings(getattr(cls, "field_mappings", {}))
+
     def _map_fields(self, payload):
-        for record_key, payload_key in self.field_mappings.items():
-            if record_key in self.record and self.record.get(record_key) != None:
-                if isinstance(payload_key, list):
-                    for key in payload_key:
-                        payload[key] = self.record.get(record_key)
-                else:
-                    record_value = self.record.get(record_key)
-                    if isinstance(record_value, datetime.datetime):
-                        record_value = record_value.isoformat()
-                        payload[payload_key] = record_value[:10] if payload_key.endswith("Date") else record_value
-                    else:
-                        payload[payload_key] = record_value
+        record = self.record
+        for record_key, payload_key, convert_datetime in self.field_mapping_plan:
+            record_value = record.get(record_key)
+            if record_value is None:
+                continue
+            if convert_datetime is not None and isinstance(record_value, datetime.datetime):
+                record_value = convert_datetime(record_value)
+            payload[payload_key] = record_value
@@ -64,33 +64,13 @@ class BillLineItemSchemaMapper(BaseMapper):
             return found_record
  
     def _map_item(self):
-        found_item = None
-
         items_reference_data = self.reference_data.get("Items", {}).get(self.company["id"], [])
 
-        item_id = self.record.get("itemId")
-        if item_id:
-            found_item = next(
-                (item for item in items_reference_data
-                if item["id"] == item_id),
-                None
-            )
-
-        item_external_id = self.record.get("itemNumber")
-        if item_external_id and not found_item:
-            found_item = next(
-                (item for item in items_reference_data
-                if item["number"] == item_external_id),
-                None
-            )
-
-        item_name = self.record.get("itemExternalName")
-        if item_name and not found_item:
-            found_item = next(
-                (item for item in items_reference_data
-                if item["displayName"] == item_name),
-                None
-            )
+        found_item = self._find_entity(
+            items_reference_data,
+            [("id", self.record.get("itemId")), ("number", self.record.get("itemNumber")), ("displayName", self.record.get("itemExternalName"))],
+            entity_type="Items"
+        )
         
         item_info = {}
 
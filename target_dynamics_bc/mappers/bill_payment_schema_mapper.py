@@ -44,10 +44,11 @@ class BillPaymentSchemaMapper(BaseMapper):
         for existing_record_pk_mapping in self.existing_record_pk_mappings:
             record_id = self.record.get(existing_record_pk_mapping["record_field"])
             if record_id:
+                dynamics_field = existing_record_pk_mapping["dynamics_field"]
+                index = self.sink.entity_index_cache.get_index(existing_entities_in_dynamics, (dynamics_field,))
                 found_record = next(
-                    (dynamics_record for dynamics_record in existing_entities_in_dynamics
-                    if dynamics_record[existing_record_pk_mapping["dynamics_field"]] == record_id
-                    and dynamics_record["journalId"] == payment_journal_id),
+                    (dynamics_record for dynamics_record in index.get_all(dynamics_field, record_id)
+                    if dynamics_record["journalId"] == payment_journal_id),
                     None
                 )
                 if existing_record_pk_mapping["required_if_present"] and found_record is None:
@@ -68,32 +69,16 @@ class BillPaymentSchemaMapper(BaseMapper):
 
 
     def _map_bill(self):
-        found_bill = None
         bill_reference_data = self.reference_data.get("Bills", {}).get(self.company["id"], [])
 
         bill_id = self.record.get("billId")
-        if bill_id:
-            found_bill = next(
-                (bill for bill in bill_reference_data
-                if bill["id"] == bill_id),
-                None
-            )
-
         bill_number = self.record.get("billNumber")
-        if bill_number and not found_bill:
-            found_bill = next(
-                (bill for bill in bill_reference_data
-                if bill["vendorInvoiceNumber"] == bill_number),
-                None
-            )
-
         bill_invoice_number = self.record.get("billExternalId")
-        if bill_invoice_number and not found_bill:
-            found_bill = next(
-                (bill for bill in bill_reference_data
-                if bill["vendorInvoiceNumber"] == bill_invoice_number),
-                None
-            )
+        found_bill = self._find_entity(
+            bill_reference_data,
+            [("id", bill_id), ("vendorInvoiceNumber", bill_number), ("vendorInvoiceNumber", bill_invoice_number)],
+            entity_type="Bills"
+        )
 
         if bill_id is None and bill_invoice_number is None and bill_number is None:
             raise InvalidInputError(f"Bill not informed. Please provide one of billId / billNumber / billExternalId")
@@ -35,17 +35,14 @@ class BillSchemaMapper(BaseMapper):
 
             is_id_field = existing_record_pk_mapping["record_field"] == "id"
 
+            dynamics_field = existing_record_pk_mapping["dynamics_field"]
             if is_id_field or not resolved_vendor_id:
-                found_record = next(
-                    (r for r in existing_entities_in_dynamics
-                     if r[existing_record_pk_mapping["dynamics_field"]] == record_id),
-                    None
-                )
+                found_record = self._find_entity(existing_entities_in_dynamics, [(dynamics_field, record_id)])
             else:
+                index = self.sink.entity_index_cache.get_index(existing_entities_in_dynamics, (dynamics_field,))
                 found_record = next(
-                    (r for r in existing_entities_in_dynamics
-                     if r[existing_record_pk_mapping["dynamics_field"]] == record_id
-                     and r.get("vendorId") == resolved_vendor_id),
+                    (r for r in index.get_all(dynamics_field, record_id)
+                     if r.get("vendorId") == resolved_vendor_id),
                     None
                 )
 
@@ -80,7 +77,29 @@ class BillSchemaMapper(BaseMapper):
             "id": payload.get("id"),
             "company_id": self.company["id"],
             "is_draft": self.record.get("isDraft", False),
-            "status": status}
+            "status": status,
+            "existing_dimension_set_lines": self._get_existing_bill_dimension_set_lines(),
+            "existing_lines_dimension_set_lines": self._get_existing_lines_dimension_set_lines()}
+
+    def _get_existing_bill_dimension_set_lines(self):
+        """
+        The dimension set lines the bill has before its dimensions are upserted. A new bill
+        inherits the default dimensions of the vendor (only available if they were expanded)
+        """
+        if self.existing_record:
+            return self.existing_record.get("dimensionSetLines", [])
+
+        found_vendor = self._find_vendor() or {}
+        return [
+            {"id": default_dimension["dimensionId"], "valueId": default_dimension["dimensionValueId"]}
+            for default_dimension in found_vendor.get("defaultDimensions", [])
+        ]
+
+    def _get_existing_lines_dimension_set_lines(self):
+        if not self.existing_record:
+            return {}
+
+        return {line["id"]: line.get("dimensionSetLines", []) for line in self.existing_record.get("purchaseInvoiceLines", [])}
 
     def _map_bill_line_items(self, payload):
         mapped_line_items = []
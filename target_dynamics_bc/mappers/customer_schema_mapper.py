@@ -45,10 +45,8 @@ class CustomerSchemaMapper(BaseMapper):
         found = None
         payment_method = self.record.get("paymentMethod")
         if payment_method:
-            found = next(
-                (item for item in self.company.get("paymentMethods", []) if item["id"] == payment_method or item["code"] == payment_method or item["displayName"] == payment_method),
-                None
-            )
+            index = self.sink.entity_index_cache.get_index(self.company.get("paymentMethods", []), ("id", "code", "displayName"))
+            found = index.find_first(id=payment_method, code=payment_method, displayName=payment_method)
 
             if found:
                 return {"paymentMethodId": found["id"]}
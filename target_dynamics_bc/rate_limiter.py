@@ -0,0 +1,133 @@
+import asyncio
+import threading
+import time
+from typing import Dict, Optional
+
+import singer
+
+LOGGER = singer.get_logger()
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket rate limiter that adapts its rate with AIMD (additive increase, multiplicative
+    decrease): every healthy response slowly increases the rate until max_rate and every throttled
+    response (429) cuts the rate by decrease_factor until min_rate.
+
+    Dynamics enforces the request limits per environment, so all the clients talking to the same
+    environment share one limiter (see get_rate_limiter).
+
+    Without a rate the requests are not paced, the limiter only keeps the metrics.
+    """
+    def __init__(self, name: str, rate: Optional[float], min_rate: float, max_rate: float, increase_step: float = 0.05, decrease_factor: float = 0.5) -> None:
+        if rate is not None and rate < 0:
+            raise ValueError(f"rate={rate} can't be negative")
+        if min_rate <= 0 or max_rate < min_rate:
+            raise ValueError(f"min_rate={min_rate} max_rate={max_rate}, 0 < min_rate <= max_rate is required")
+
+        self.name = name
+        self.enabled = bool(rate)
+        # the rate is kept in the limits, so it never gets to 0
+        self.rate = min(max(rate, min_rate), max_rate) if self.enabled else None
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+
+        self._lock = threading.Lock()
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+
+        self.requests = 0
+        self.throttled = 0
+        self.waited_seconds = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        # the bucket holds at most one second worth of requests
+        self._tokens = min(max(self.rate, 1.0), self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def try_acquire(self) -> float:
+        """Takes a token if there is one available, otherwise returns how long to wait for the next one"""
+        with self._lock:
+            if not self.enabled:
+                self.requests += 1
+                return 0
+
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.requests += 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def _add_waited_seconds(self, start: float):
+        # the time actually slept is measured, the planned waits are shorter when the sleeps overrun
+        with self._lock:
+            self.waited_seconds += time.monotonic() - start
+
+    def acquire(self):
+        """Blocks until a request can be made without going over the current rate"""
+        wait = self.try_acquire()
+        if not wait:
+            return
+
+        start = time.monotonic()
+        while wait:
+            time.sleep(wait)
+            wait = self.try_acquire()
+        self._add_waited_seconds(start)
+
+    async def acquire_async(self):
+        """Same as acquire, but waits without blocking the event loop"""
+        wait = self.try_acquire()
+        if not wait:
+            return
+
+        start = time.monotonic()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.try_acquire()
+        self._add_waited_seconds(start)
+
+    def on_success(self):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self):
+        with self._lock:
+            self.throttled += 1
+            if not self.enabled:
+                return
+
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            # drop the accumulated burst so we really slow down
+            self._tokens = 0
+            rate = self.rate
+
+        LOGGER.warning(f"Throttled by Dynamics, reducing request rate for {self.name} to {rate:.2f} requests/s")
+
+    def get_metrics(self) -> Dict:
+        with self._lock:
+            return {
+                "environment": self.name,
+                "rate": round(self.rate, 2) if self.enabled else None,
+                "max_rate": self.max_rate,
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "waited_seconds": round(self.waited_seconds, 2)
+            }
+
+
+_rate_limiters: Dict[str, AdaptiveRateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(name: str, rate: Optional[float], min_rate: float, max_rate: float) -> AdaptiveRateLimiter:
+    """Returns the rate limiter for the given environment, creating it if needed"""
+    with _rate_limiters_lock:
+        if name not in _rate_limiters:
+            _rate_limiters[name] = AdaptiveRateLimiter(name, rate, min_rate, max_rate)
+        return _rate_limiters[name]
@@ -0,0 +1,79 @@
+import json
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import singer
+
+from target_hotglue.common import HGJSONEncoder
+
+from target_dynamics_bc.utils import Company
+
+LOGGER = singer.get_logger()
+
+class ReferenceDataCache:
+    """
+    Persists the companies reference data in the snapshot directory so it can be reused
+    across job runs.
+
+    While the cache is younger than the ttl it's revalidated by only fetching what changed
+    since it was saved. Once it expires the reference data is fully loaded again, which is
+    also how deleted entities are dropped from the cache.
+    """
+    file_name = "dynamics-bc-reference-data.json"
+
+    def __init__(self, snapshot_directory: str, url: str, ttl: int) -> None:
+        self.path = os.path.join(snapshot_directory, self.file_name)
+        self.url = url
+        self.ttl = timedelta(seconds=ttl)
+        self.cached_at: Optional[datetime] = None
+
+    def load(self) -> Optional[List[Company]]:
+        """Returns the cached companies or None if there is no valid cache"""
+        if not os.path.exists(self.path):
+            LOGGER.info(f"Reference data cache does not exist at {self.path}")
+            return None
+
+        try:
+            with open(self.path) as f:
+                cache = json.load(f)
+            cached_at = datetime.fromisoformat(cache["cached_at"])
+            companies = cache["companies"]
+        except OSError as e:
+            # e.g. deleted or made unreadable since it was checked, the reference data is fully loaded
+            LOGGER.warning(f"Could not read reference data cache at {self.path}: {e}")
+            return None
+        except (ValueError, KeyError, TypeError) as e:
+            LOGGER.warning(f"Ignoring invalid reference data cache at {self.path}: {e}")
+            return None
+
+        # the cache is only valid for the environment it was loaded from
+        if cache.get("url") != self.url:
+            LOGGER.info(f"Reference data cache at {self.path} belongs to a different environment")
+            return None
+
+        if cached_at + self.ttl <= datetime.utcnow():
+            LOGGER.info(f"Reference data cache at {self.path} expired")
+            return None
+
+        self.cached_at = cached_at
+        return companies
+
+    def save(self, companies: List[Company]):
+        # revalidating the cache doesn't extend its lifetime, only a full load does
+        cached_at = self.cached_at or datetime.utcnow()
+
+        cache = {
+            "url": self.url,
+            "cached_at": cached_at.isoformat(),
+            "companies": companies
+        }
+
+        # the cache is an optimization, failing to write it shouldn't fail the job
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(cache, f, cls=HGJSONEncoder)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            LOGGER.warning(f"Could not save reference data cache at {self.path}: {e}")
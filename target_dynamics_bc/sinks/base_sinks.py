@@ -1,15 +1,17 @@
 import abc
+import asyncio
 import hashlib
-import json
-from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
 
 from singer_sdk.plugin_base import PluginBase
 from singer_sdk.sinks import BatchSink
 from target_hotglue.client import HotglueBaseSink
-from target_hotglue.common import HGJSONEncoder
 
+from target_dynamics_bc.async_client import AsyncDynamicsClient
 from target_dynamics_bc.client import DynamicsClient
-from target_dynamics_bc.utils import extract_error_message
+from target_dynamics_bc.json_codec import JSONCodec, get_codec
+from target_dynamics_bc.utils import EntityCache, EntityIndexCache, LookupCache, extract_error_message
 
 class DynamicsBaseBatchSink(HotglueBaseSink, BatchSink):
     max_size = 1000 # max allowed by dynamics is 1000
@@ -24,6 +26,31 @@ class DynamicsBaseBatchSink(HotglueBaseSink, BatchSink):
         super().__init__(target, stream_name, schema, key_properties)
         self.dynamics_client: DynamicsClient = self._target.dynamics_client
 
+        # hash -> successful state index of the states in latest_state bookmarks
+        self._state_hash_index: Dict[str, dict] = {}
+        self._indexed_states: Optional[List[dict]] = None
+        self._indexed_states_count = 0
+
+        # the hashes are stored in the state and the idempotency store, the fast codec changes them
+        # so it's only used for hashing with fast_record_hash
+        self.record_hash_codec = get_codec(self.config.get("json_codec")) if self.config.get("fast_record_hash") else JSONCodec()
+
+        # indexes and memoized lookups of the reference data used by the mappers, reset for every batch
+        self.entity_index_cache = EntityIndexCache()
+        self.lookup_cache = LookupCache()
+
+    # the company reference data collections used to map the records of the sink,
+    # only the collections of the streams in the job are loaded. None means all of them
+    reference_collections: Optional[List[str]] = None
+
+    # the entities upserted by the sink are written through to the run-scoped entity cache,
+    # so the sinks looking them up later in the run don't need to fetch them
+    cache_upserted_entities = False
+
+    # the fields the upserted entities are looked up by (field -> should_quote), their values
+    # are written through with the entity so lookups by any of them are answered by the cache
+    cached_filter_fields: Dict[str, bool] = {"id": False}
+
     @abc.abstractmethod
     def preprocess_batch(self, records: List[dict]):
         """
@@ -41,17 +68,152 @@ class DynamicsBaseBatchSink(HotglueBaseSink, BatchSink):
         """
         return record
 
+    def reset_lookup_caches(self):
+        self.entity_index_cache.clear()
+        self.lookup_cache.clear()
+
+    def log_lookup_cache_metrics(self):
+        metrics = self.lookup_cache.get_metrics()
+        if metrics["hits"] or metrics["misses"]:
+            self.logger.info(f"{self.name} reference lookups: {metrics}")
+
+    def write_cached_entity(self, company_id: Optional[str], entity) -> None:
+        """Writes through an entity upserted by the sink to the run-scoped entity cache"""
+        entity_cache = self._target.entity_cache
+        if entity_cache and self.cache_upserted_entities and company_id and isinstance(entity, dict):
+            filter_values = {
+                field: DynamicsClient.format_filter_value(entity[field], should_quote)
+                for field, should_quote in self.cached_filter_fields.items()
+                if entity.get(field) is not None
+            }
+            entity_cache.write(self.record_type, company_id, entity, filter_values)
+
+    def invalidate_cached_entity(self, company_id: Optional[str], entity_id: Optional[str]) -> None:
+        entity_cache = self._target.entity_cache
+        if entity_cache and company_id and entity_id:
+            entity_cache.invalidate(self.record_type, company_id, entity_id)
+
+    def get_etag_headers(self, existing_record: Optional[dict]) -> dict:
+        """
+        With use_etags existing records are updated with their ETag instead of If-Match: *,
+        so they are not updated if they were modified by someone else since they were fetched
+        """
+        if not self.config.get("use_etags") or not existing_record:
+            return {}
+
+        etag = existing_record.get("@odata.etag")
+        return {"If-Match": etag} if etag else {}
+
+    def run_async(self, coroutine_function: Callable[[AsyncDynamicsClient], Awaitable]):
+        """Runs coroutine_function with the async client of the target and returns its result"""
+        return self._target.async_client.run(coroutine_function)
+
+    def get_existing_entities_for_records(self, record_type: str, records: List[Dict], filter_mappings: List[Dict], expand: Optional[str] = None, entity_cache: Optional[EntityCache] = None) -> Dict[str, List]:
+        """
+        Same as DynamicsClient.get_existing_entities_for_records for the companies of the target.
+        With use_async_client the companies are queried concurrently
+        """
+        companies = self._target.reference_data.get("companies", [])
+
+        if self.config.get("use_async_client"):
+            return self.run_async(lambda client: client.get_existing_entities_for_records(companies, record_type, records, filter_mappings, expand, entity_cache))
+
+        return self.dynamics_client.get_existing_entities_for_records(companies, record_type, records, filter_mappings, expand=expand, entity_cache=entity_cache)
+
     def build_record_hash(self, record: dict):
-        return hashlib.sha256(json.dumps(record, cls=HGJSONEncoder).encode()).hexdigest()
+        return hashlib.sha256(self.record_hash_codec.dumps(record)).hexdigest()
 
     def hash_records(self, records: List[dict]):
         for record in records:
             record["hash"] = self.build_record_hash(record)
 
-    def get_existing_state(self, hash: str):
+    def filter_applied_records(self, raw_records: List[dict]) -> Tuple[List[dict], List[str]]:
+        """
+        Hashes the records and skips the ones already applied to Dynamics in previous job runs.
+        Returns the records to process and their hashes
+        """
+        idempotency_store = self._target.idempotency_store
+
+        records = []
+        record_hashes = []
+        for raw_record in raw_records:
+            record_hash = self.build_record_hash(raw_record)
+
+            applied_record = idempotency_store.get(self.name, record_hash) if idempotency_store else None
+            if applied_record:
+                self.logger.info(f"Record already applied to Dynamics in a previous run with id={applied_record['id']}. Won't process it.")
+                # the record keeps its state in this run, with the id it got in Dynamics
+                state = {"hash": record_hash, "id": applied_record["id"], "success": True, "existing": True}
+                external_id = raw_record.get("externalId")
+                if external_id:
+                    state["externalId"] = external_id
+                self.update_state(state, is_duplicate=True)
+                continue
+
+            records.append(raw_record)
+            record_hashes.append(record_hash)
+
+        return records, record_hashes
+
+    def save_applied_record(self, record_hash: str, state: dict):
+        """Saves the successfully applied record so it can be skipped in the next job runs"""
+        idempotency_store = self._target.idempotency_store
+        if not idempotency_store or not state.get("success"):
+            return
+
+        outcome = "unchanged" if state.get("is_unchanged") else "updated" if state.get("is_updated") else "created"
+        idempotency_store.put(self.name, record_hash, state.get("id"), outcome)
+
+    @abc.abstractmethod
+    def process_batch_records(self, context: dict) -> None:
+        """Maps and upserts the records of the batch and updates their state"""
+        pass
+
+    def process_batch(self, context: dict) -> None:
+        try:
+            self.process_batch_records(context)
+        finally:
+            # the applied records are saved once per batch, even if the batch failed midway
+            if self._target.idempotency_store:
+                self._target.idempotency_store.commit()
+
+    def update_state(self, state: dict, *args, **kwargs):
+        is_unchanged = state.pop("is_unchanged", False)
+        super().update_state(state, *args, **kwargs)
+
+        # unchanged records are successful, but they are reported apart in the summary
+        if is_unchanged and state.get("success"):
+            summary = self.latest_state["summary"][self.name]
+            summary["success"] -= 1
+            summary["unchanged"] = summary.get("unchanged", 0) + 1
+
+        self.index_states()
+
+    def index_states(self):
+        """
+        Adds the states appended to the bookmarks since the last call to the hash index, so
+        looking for an existing state doesn't need to scan all the states
+        """
         states = self.latest_state["bookmarks"][self.name]
 
-        existing_state = next((s for s in states if hash==s.get("hash") and s.get("success")), None)
+        # the bookmarks were replaced, the index needs to be rebuilt
+        if states is not self._indexed_states:
+            self._state_hash_index = {}
+            self._indexed_states = states
+            self._indexed_states_count = 0
+
+        for state in states[self._indexed_states_count:]:
+            state_hash = state.get("hash")
+            if state_hash and state.get("success"):
+                # keep the first state for the hash, same as scanning the states in order
+                self._state_hash_index.setdefault(state_hash, state)
+
+        self._indexed_states_count = len(states)
+
+    def get_existing_state(self, hash: str):
+        self.index_states()
+
+        existing_state = self._state_hash_index.get(hash)
 
         if existing_state:
             self.latest_state["summary"][self.name]["existing"] += 1
@@ -90,29 +252,91 @@ class DynamicsBaseBatchSinkBatchUpsert(DynamicsBaseBatchSink):
     upsert requests to Dynamics in batches
     """
 
+    @staticmethod
+    def build_requests_data(record: dict) -> List[dict]:
+        requests_data = []
+        for request in record["records"]:
+            data = {
+                "method": request["request_params"]["method"],
+                "url": request["request_params"]["url"],
+                "headers": {
+                    **request["request_params"].get("headers", {})
+                },
+                "body": request["payload"]
+            }
+            requests_data.append(data)
+
+        return requests_data
+
     def make_batch_request(self, records: List[dict], transaction_type: str = "non_atomic"):
         if not records:
             return []
 
+        # the requests of non atomic records are sent together, the client splits them in chunks
+        if transaction_type != "atomic":
+            requests_data = [request for record in records for request in self.build_requests_data(record)]
+            return self.dynamics_client.make_batch_request(requests_data) if requests_data else []
+
         responses = []
         for record in records:
-            requests_data = []
-            for request in record["records"]:
-                data = {
-                    "method": request["request_params"]["method"],
-                    "url": request["request_params"]["url"],
-                    "headers": {
-                        **request["request_params"].get("headers", {})
-                    },
-                    "body": request["payload"]
-                }
-                requests_data.append(data)
-
+            requests_data = self.build_requests_data(record)
             if requests_data:
                 responses += self.dynamics_client.make_batch_request(requests_data, transaction_type=transaction_type)
 
         return responses
 
+    async def make_batch_request_async(self, client: AsyncDynamicsClient, records: List[dict], transaction_type: str = "non_atomic"):
+        """Same as make_batch_request, but the batch requests are sent concurrently"""
+        if transaction_type != "atomic":
+            requests_data = [request for record in records for request in self.build_requests_data(record)]
+            return await client.make_batch_request(requests_data) if requests_data else []
+
+        records_responses = await asyncio.gather(*[
+            client.make_batch_request(self.build_requests_data(record), transaction_type=transaction_type)
+            for record in records
+            if record["records"]
+        ])
+
+        return [response for record_responses in records_responses for response in record_responses]
+
+    def build_atomicity_groups_requests_data(self, records: List[dict]) -> List[dict]:
+        """Builds the requests of the atomic records, the requests of each record are in their own atomicity group"""
+        requests_data = []
+        for record in records:
+            atomicity_group = f"record_{record['raw_record_index']}"
+            for index, request in enumerate(self.build_requests_data(record)):
+                requests_data.append({**request, "request_id": f"{atomicity_group}_{index}", "atomicity_group": atomicity_group})
+
+        return requests_data
+
+    @staticmethod
+    def group_responses_by_record(records: List[dict], requests_data: List[dict], responses: List[dict]) -> List[List[dict]]:
+        """Returns the responses of the atomicity group of each record, in the order of its requests"""
+        responses_by_id = {response.get("id"): response for response in responses}
+        missing_response = {"status": 500, "body": "Dynamics did not return a response for the request"}
+
+        records_responses = {f"record_{record['raw_record_index']}": [] for record in records}
+        for request in requests_data:
+            records_responses[request["atomicity_group"]].append(responses_by_id.get(request["request_id"], missing_response))
+
+        return list(records_responses.values())
+
+    def make_atomicity_groups_batch_request(self, records: List[dict]) -> List[List[dict]]:
+        """
+        Sends the requests of all the atomic records in shared batch requests, each record in its own
+        atomicity group so if one of its requests fails only the requests of that record are rolled back.
+        Returns the responses of each record
+        """
+        requests_data = self.build_atomicity_groups_requests_data(records)
+        responses = self.dynamics_client.make_batch_request(requests_data) if requests_data else []
+        return self.group_responses_by_record(records, requests_data, responses)
+
+    async def make_atomicity_groups_batch_request_async(self, client: AsyncDynamicsClient, records: List[dict]) -> List[List[dict]]:
+        """Same as make_atomicity_groups_batch_request, but the chunks are sent concurrently"""
+        requests_data = self.build_atomicity_groups_requests_data(records)
+        responses = await client.make_batch_request(requests_data) if requests_data else []
+        return self.group_responses_by_record(records, requests_data, responses)
+
     def handle_non_atomic_batch_response(self, responses: List[dict], records: List[dict], raw_records: List[dict]) -> dict:
         """
         This method should return a dict.
@@ -138,6 +362,7 @@ class DynamicsBaseBatchSinkBatchUpsert(DynamicsBaseBatchSink):
             if response["status"] in [200, 201]:
                 state["success"] = True
                 state["id"] = response.get("body", {}).get("id")
+                self.write_cached_entity(record.get("company_id"), response.get("body"))
 
             if response["status"] == 200:
                 state["is_updated"] = True
@@ -145,6 +370,9 @@ class DynamicsBaseBatchSinkBatchUpsert(DynamicsBaseBatchSink):
             if response["status"] >= 400:
                 state["success"] = False
                 state["error"] = extract_error_message(response)
+
+            if response["status"] == 412:
+                state["precondition_failed"] = True
             state_updates.append(state)
 
         return {"state_updates": state_updates}
@@ -153,70 +381,114 @@ class DynamicsBaseBatchSinkBatchUpsert(DynamicsBaseBatchSink):
         """
         This method should return a dict with the state update
         
-        for the atomic batch request all the requests are related to one entity
-        if one fails it will stop executing, so we check the last response code
-        if it's an error we return an error state.
+        for the atomic batch request (or atomicity group) all the requests are related to one entity
+        if one fails the others are rolled back, so if any of the responses is an error we return an
+        error state with the request that failed (the other ones fail with 424 Failed Dependency).
         if it's success we look for the code in the first response (which is the
         response for the main entity)
 
-        responses: a list of responses from the API
+        responses: the responses of the record requests, in the same order
         record: used to make the requests to the API
         """
         state = {}
 
         first_response = responses[0]
-        last_response = responses[-1]
 
         raw_record = raw_records[record["raw_record_index"]]
         external_id = raw_record.get("externalId")
         if external_id:
             state["externalId"] = external_id
 
-        if last_response["status"] >= 400:
+        failed_responses = [response for response in responses if response["status"] >= 400]
+        if failed_responses:
+            failed_response = next((response for response in failed_responses if response["status"] != 424), failed_responses[0])
             state["success"] = False
-            state["error"] = extract_error_message(last_response)
+            state["error"] = extract_error_message(failed_response)
+            if failed_response["status"] == 412:
+                state["precondition_failed"] = True
             return state
 
         state["success"] = True
         state["id"] = first_response.get("body", {}).get("id")
+        self.write_cached_entity(record.get("company_id"), first_response.get("body"))
 
         if first_response["status"] == 200:
             state["is_updated"] = True
 
         return state
     
-    def process_batch(self, context: dict) -> None:
+    def process_batch_records(self, context: dict) -> None:
         if not self.latest_state:
             self.init_state()
 
-        raw_records = context.get("records", [])
+        raw_records, record_hashes = self.filter_applied_records(context.get("records", []))
         if not raw_records:
             return
 
+        self.reset_lookup_caches()
+        self._target.prefetch_reference_data(raw_records)
         self.preprocess_batch(raw_records)
 
         records = []
         for index, raw_record in enumerate(raw_records):
-            try:
-                record_hash = self.build_record_hash(raw_record)
-                # if the record is duplicated within this job run we skip it
-                if self.get_existing_state(record_hash):
-                    continue
-                # performs record mapping from unified to Dynamics
-                record = self.process_batch_record(raw_record)
-                record["raw_record_index"] = index
+            # if the record is duplicated within this job run we skip it
+            if self.get_existing_state(record_hashes[index]):
+                continue
+
+            record, state = self.map_batch_record(raw_record, index)
+            if state is None:
                 records.append(record)
-            except Exception as e:
-                state = {"success": False, "error": str(e)}
-                record_id = raw_record.get("id")
-                if record_id:
-                    state["id"] = record_id
-                external_id = raw_record.get("externalId")
-                if external_id:
-                    state["externalId"] = external_id
+                continue
 
-                self.update_state(state)
+            if record is not None:
+                self.save_applied_record(record_hashes[index], state)
+            self.update_state(state, record=record)
+
+        self.log_lookup_cache_metrics()
+
+        record_states = self.send_batch_records(records, raw_records)
+
+        if self.config.get("use_etags"):
+            record_states = self.retry_modified_records(record_states, raw_records)
+
+        for record, state in record_states:
+            state.pop("precondition_failed", None)
+            self.save_applied_record(record_hashes[record["raw_record_index"]], state)
+            self.update_state(state, record=record)
+
+    def map_batch_record(self, raw_record: dict, index: int) -> Tuple[Optional[dict], Optional[dict]]:
+        """
+        Maps the raw record and returns (record, state). The state is only returned if the record
+        doesn't need to be sent to Dynamics, because it failed to be mapped (then record is None)
+        or because it didn't change
+        """
+        try:
+            # performs record mapping from unified to Dynamics
+            record = self.process_batch_record(raw_record)
+            record["raw_record_index"] = index
+        except Exception as e:
+            state = {"success": False, "error": str(e)}
+            record_id = raw_record.get("id")
+            if record_id:
+                state["id"] = record_id
+            external_id = raw_record.get("externalId")
+            if external_id:
+                state["externalId"] = external_id
+
+            return None, state
 
+        # the record already exists in Dynamics as it is, there is nothing to send
+        if record.get("is_unchanged"):
+            state = {"success": True, "id": record["id"], "is_unchanged": True}
+            external_id = raw_record.get("externalId")
+            if external_id:
+                state["externalId"] = external_id
+            return record, state
+
+        return record, None
+
+    def send_batch_records(self, records: List[dict], raw_records: List[dict]) -> List[Tuple[dict, dict]]:
+        """Sends the requests of the records and returns the (record, state) of each of them"""
         # separate atomic and non atomic records
         # 
         # non atomic records are records that just need one API operation, we bulk
@@ -230,15 +502,80 @@ class DynamicsBaseBatchSinkBatchUpsert(DynamicsBaseBatchSink):
         atomic_records = [record for record in records if len(record["records"])>1]
         non_atomic_records = [record for record in records if len(record["records"])==1] 
 
-        non_atomic_responses = self.make_batch_request(non_atomic_records)
+        if self.config.get("use_async_client"):
+            non_atomic_responses, atomic_records_responses = self.send_batch_requests_async(non_atomic_records, atomic_records)
+        else:
+            non_atomic_responses = self.make_batch_request(non_atomic_records)
+
+            if self.config.get("atomicity_groups"):
+                atomic_records_responses = self.make_atomicity_groups_batch_request(atomic_records)
+            else:
+                atomic_records_responses = [self.make_batch_request([atomic_record], transaction_type="atomic") for atomic_record in atomic_records]
+
         result = self.handle_non_atomic_batch_response(non_atomic_responses, non_atomic_records, raw_records)
-        for state, record in zip(result.get("state_updates", list()), non_atomic_records):
-            self.update_state(state, record=record)
+        record_states = list(zip(non_atomic_records, result.get("state_updates", list())))
+
+        for atomic_record, atomic_responses in zip(atomic_records, atomic_records_responses):
+            record_states.append((atomic_record, self.handle_atomic_batch_response(atomic_responses, atomic_record, raw_records)))
+
+        return record_states
+
+    def send_batch_requests_async(self, non_atomic_records: List[dict], atomic_records: List[dict]) -> Tuple[List[dict], List[List[dict]]]:
+        """
+        Sends the non atomic and all the atomic batch requests concurrently using the async client.
+        Returns the non atomic responses and the responses of each atomic record
+        """
+        async def send_requests(client: AsyncDynamicsClient):
+            if self.config.get("atomicity_groups"):
+                return await asyncio.gather(
+                    self.make_batch_request_async(client, non_atomic_records),
+                    self.make_atomicity_groups_batch_request_async(client, atomic_records)
+                )
+
+            return await asyncio.gather(
+                self.make_batch_request_async(client, non_atomic_records),
+                asyncio.gather(*[self.make_batch_request_async(client, [atomic_record], transaction_type="atomic") for atomic_record in atomic_records])
+            )
+
+        non_atomic_responses, atomic_records_responses = self.run_async(send_requests)
+        return non_atomic_responses, atomic_records_responses
+
+    def retry_modified_records(self, record_states: List[Tuple[dict, dict]], raw_records: List[dict]) -> List[Tuple[dict, dict]]:
+        """
+        With use_etags the existing records are only updated if their ETag still matches, otherwise Dynamics
+        responds 412 (Precondition Failed) because the record was modified since it was fetched.
+        Those records are fetched and mapped again and retried, up to etag_retries times
+        """
+        record_states = list(record_states)
+
+        for attempt in range(int(self.config.get("etag_retries", 3))):
+            modified_positions = [position for position, (_, state) in enumerate(record_states) if state.get("precondition_failed")]
+            if not modified_positions:
+                break
 
-        for atomic_record in atomic_records:
-            atomic_responses = self.make_batch_request([atomic_record], transaction_type="atomic")
-            state = self.handle_atomic_batch_response(atomic_responses, atomic_record, raw_records)
-            self.update_state(state, record=atomic_record)
+            self.logger.info(f"{len(modified_positions)} {self.name} were modified in Dynamics since they were fetched. Fetching and retrying them ({attempt + 1})")
+
+            raw_record_indexes = [record_states[position][0]["raw_record_index"] for position in modified_positions]
+            self.reset_lookup_caches()
+            self.preprocess_batch([raw_records[index] for index in raw_record_indexes])
+
+            retried_records = {}
+            for position, index in zip(modified_positions, raw_record_indexes):
+                record, state = self.map_batch_record(raw_records[index], index)
+                if record is None:
+                    # the record is kept to know its raw record
+                    record = {"raw_record_index": index}
+                if state is None:
+                    retried_records[position] = record
+                else:
+                    record_states[position] = (record, state)
+
+            retried_record_states = self.send_batch_records(list(retried_records.values()), raw_records)
+            retried_states_by_index = {record["raw_record_index"]: (record, state) for record, state in retried_record_states}
+            for position, record in retried_records.items():
+                record_states[position] = retried_states_by_index[record["raw_record_index"]]
+
+        return record_states
 
 
 class DynamicsBaseBatchSinkSingleUpsert(DynamicsBaseBatchSink):
@@ -258,22 +595,141 @@ class DynamicsBaseBatchSinkSingleUpsert(DynamicsBaseBatchSink):
         """
         pass
 
-    def process_batch(self, context: dict) -> None:
+    def make_staged_batch_request(self, stage_requests: Dict[int, List[dict]]) -> Dict[int, List[dict]]:
+        """
+        Sends the requests of a stage for all the records in shared batch requests.
+        stage_requests maps the record index to the requests of the record, the responses are
+        returned the same way. With use_async_client the batch requests of the stage are sent concurrently
+        """
+        requests_data = [
+            {**request, "request_id": f"{record_index}_{request_index}"}
+            for record_index, record_requests in stage_requests.items()
+            for request_index, request in enumerate(record_requests)
+        ]
+        missing_response = {"status": 500, "body": "Dynamics did not return a response for the request"}
+        try:
+            if not requests_data:
+                responses = []
+            elif self.config.get("use_async_client"):
+                responses = self.run_async(lambda client: client.make_batch_request(requests_data))
+            else:
+                responses = self.dynamics_client.make_batch_request(requests_data)
+        except Exception as e:
+            # only the records of the stage fail, the records already done in previous stages keep their result
+            self.logger.warning(f"{self.name} stage batch request failed: {e}")
+            responses = []
+            missing_response = {"status": 500, "body": str(e)}
+        responses_by_id = {response.get("id"): response for response in responses}
+
+        return {
+            record_index: [responses_by_id.get(f"{record_index}_{request_index}", missing_response) for request_index in range(len(record_requests))]
+            for record_index, record_requests in stage_requests.items()
+        }
+
+    def get_upsert_stages(self) -> List[Tuple[Callable[[Dict], List[dict]], Callable[[Dict, List[dict]], Optional[str]]]]:
+        """
+        The stages to upsert a record with upsert_records_in_stages, in order. Each stage is a pair of
+        methods (build_requests, handle_responses): build_requests returns the requests of the stage for
+        the upsert of a record, the record skips the stage if there are none, and handle_responses gets
+        their responses and returns the error message if the record failed
+        """
+        return []
+
+    def build_upsert(self, record: Dict) -> Dict:
+        """
+        Returns the upsert of the record passed to the stages, the stages keep in it what they need from
+        the previous stages. "id" is the id of the entity once it's created
+        """
+        payload = dict(record["payload"])
+        entity_id = payload.pop("id", None)
+        return {"company_id": record["company_id"], "id": entity_id, "is_update": entity_id is not None, "payload": payload}
+
+    def upsert_records_in_stages(self, records: List[Dict]) -> List[Union[Tuple[str, bool, Dict], Exception]]:
+        """
+        Upserts the records stage by stage, the requests of each stage are sent for all the records together.
+        Records that fail in a stage are not processed in the next stages, they keep the id of the entity if it
+        was already created. Returns the same results as upsert_records
+        """
+        results = [None] * len(records)
+        upserts = {}
+        for index, record in enumerate(records):
+            try:
+                upserts[index] = self.build_upsert(record)
+            except Exception as e:
+                results[index] = e
+
+        for build_requests, handle_responses in self.get_upsert_stages():
+            stage_requests = {}
+            for index, upsert in upserts.items():
+                if upsert.get("error") is not None:
+                    continue
+                try:
+                    requests_data = build_requests(upsert)
+                except Exception as e:
+                    upsert["error"] = str(e)
+                    continue
+                if requests_data:
+                    stage_requests[index] = requests_data
+
+            for index, responses in self.make_staged_batch_request(stage_requests).items():
+                try:
+                    upserts[index]["error"] = handle_responses(upserts[index], responses)
+                except Exception as e:
+                    upserts[index]["error"] = str(e)
+
+        for index, upsert in upserts.items():
+            if upsert.get("error") is not None:
+                results[index] = (upsert["id"], False, {"error": upsert["error"]})
+            else:
+                results[index] = (upsert["id"], True, {"is_updated": True} if upsert["is_update"] else {})
+
+        return results
+
+    def upsert_record_in_stages(self, record: Dict) -> Tuple[str, bool, Dict]:
+        """Upserts one record with the stages of upsert_records_in_stages"""
+        result = self.upsert_records_in_stages([record])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def handle_write_responses(self, upsert: Dict, responses: List[dict], success_statuses: Tuple[int, ...] = (200, 201)) -> Optional[str]:
+        """Stage responses handler for the stages that only write, returns the error of the first failed response"""
+        failed_response = next((response for response in responses if response.get("status") not in success_statuses), None)
+        return extract_error_message(failed_response) if failed_response else None
+
+    def build_refetch_requests(self, upsert: Dict, url_params: dict, expand: str) -> List[dict]:
+        """Builds the request to fetch the upserted entity again, to get the entities Dynamics added to it"""
+        return self.dynamics_client.build_get_entities_requests(self.record_type, url_params, {"id": [upsert["id"]]}, expand)
+
+    def get_refetched_entity(self, responses: List[dict]) -> Tuple[Optional[dict], Optional[str]]:
+        """Returns the entity of the build_refetch_requests responses, or the error message if it couldn't be fetched"""
+        error_message = self.handle_write_responses(None, responses, success_statuses=(200,))
+        if error_message:
+            return None, error_message
+
+        entities = responses[0].get("body", {}).get("value", [])
+        if not entities:
+            return None, f"Could not find the upserted {self.name} entity in Dynamics"
+
+        return entities[0], None
+
+    def process_batch_records(self, context: dict) -> None:
         if not self.latest_state:
             self.init_state()
 
-        raw_records = context.get("records", [])
+        raw_records, record_hashes = self.filter_applied_records(context.get("records", []))
         if not raw_records:
             return
 
+        self.reset_lookup_caches()
+        self._target.prefetch_reference_data(raw_records)
         self.preprocess_batch(raw_records)
 
         records = []
         for index, raw_record in enumerate(raw_records):
             try:
-                record_hash = self.build_record_hash(raw_record)
                 # if the record is duplicated within this job run we skip it
-                if self.get_existing_state(record_hash):
+                if self.get_existing_state(record_hashes[index]):
                     continue
 
                 # performs record mapping from unified to Dynamics
@@ -290,29 +746,99 @@ class DynamicsBaseBatchSinkSingleUpsert(DynamicsBaseBatchSink):
                     state["externalId"] = external_id
                 self.update_state(state)
 
-        for record in records:
-            try:
-                raw_record_idx = record.pop("raw_record_index", None)
-                raw_record = raw_records[raw_record_idx] if raw_record_idx is not None else {}
-                external_id = raw_record.get("externalId")
-                id, success, state = self.upsert_record(record)
-            except  Exception as e:
-                state = {"success": False, "error": str(e)}
-                record_id = record.get("id")
-                if record_id:
-                    state["id"] = record_id
-                if external_id:
-                    state["externalId"] = external_id
-                self.update_state(state, record=record)
-            else:
-                if success:
-                    self.logger.info(f"{self.name} processed id: {id}")
+        self.log_lookup_cache_metrics()
 
-                state["success"] = success
+        # upsert_records_with_states pops raw_record_index from the records
+        records_hashes = [record_hashes[record["raw_record_index"]] for record in records]
 
-                if id:
-                    state["id"] = id
-                if external_id:
-                    state["externalId"] = external_id
-                
-                self.update_state(state, record=record)
+        # the state is only updated from this thread and in the same order of the records
+        states = self.upsert_records_with_states(records, raw_records)
+        for record, record_hash, state in zip(records, records_hashes, states):
+            self.save_applied_record(record_hash, state)
+            self.update_state(state, record=record)
+
+    def upsert_records(self, records: List[Dict]) -> List[Union[Tuple[str, bool, Dict], Exception]]:
+        """
+        Upserts the records of the batch with upsert_record and returns the result of each record in the
+        same order, or the exception that made it fail. With max_workers > 1 the records are upserted
+        concurrently. Sinks that can upsert all the records together override it
+        """
+        max_workers = int(self.config.get("max_workers", 1))
+        if max_workers <= 1:
+            return [self.try_upsert_record(record) for record in records]
+
+        # records are upserted concurrently, but records for the same entity are upserted
+        # sequentially in the same worker so they don't overwrite each other
+        record_lanes = {}
+        for index, record in enumerate(records):
+            concurrency_key = self.get_record_concurrency_key(record) or f"record_{index}"
+            record_lanes.setdefault(concurrency_key, []).append(index)
+
+        results = [None] * len(records)
+
+        def upsert_lane(record_indexes: List[int]):
+            for record_index in record_indexes:
+                results[record_index] = self.try_upsert_record(records[record_index])
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(upsert_lane, record_indexes) for record_indexes in record_lanes.values()]
+            for future in futures:
+                future.result()
+
+        return results
+
+    def try_upsert_record(self, record: Dict) -> Union[Tuple[str, bool, Dict], Exception]:
+        try:
+            return self.upsert_record(record)
+        except Exception as e:
+            return e
+
+    def get_record_concurrency_key(self, record: Dict) -> Optional[str]:
+        """
+        Records with the same key are never upserted concurrently. By default records that
+        update the same existing entity share the same key
+        """
+        return record.get("payload", {}).get("id")
+
+    def upsert_records_with_states(self, records: List[Dict], raw_records: List[dict]) -> List[Dict]:
+        """Calls upsert_records and builds the state for each record"""
+        external_ids = [self.pop_record_external_id(record, raw_records) for record in records]
+        try:
+            results = self.upsert_records(records)
+        except Exception as e:
+            # upsert_records handles the errors of each record, this only happens if it failed before upserting them
+            results = [e] * len(records)
+
+        return [self.build_upsert_state(record, external_id, result) for record, external_id, result in zip(records, external_ids, results)]
+
+    def pop_record_external_id(self, record: Dict, raw_records: List[dict]) -> Optional[str]:
+        raw_record_idx = record.pop("raw_record_index", None)
+        raw_record = raw_records[raw_record_idx] if raw_record_idx is not None else {}
+        return raw_record.get("externalId")
+
+    def build_upsert_state(self, record: Dict, external_id: Optional[str], result: Union[Tuple[str, bool, Dict], Exception]) -> Dict:
+        if isinstance(result, Exception):
+            state = {"success": False, "error": str(result)}
+            record_id = record.get("id")
+            if record_id:
+                state["id"] = record_id
+            if external_id:
+                state["externalId"] = external_id
+            return state
+
+        id, success, state = result
+        if success:
+            self.logger.info(f"{self.name} processed id: {id}")
+
+        # the entity could have been partially updated even if the upsert failed
+        for entity_id in {id, record.get("id")}:
+            self.invalidate_cached_entity(record.get("company_id"), entity_id)
+
+        state["success"] = success
+
+        if id:
+            state["id"] = id
+        if external_id:
+            state["externalId"] = external_id
+
+        return state
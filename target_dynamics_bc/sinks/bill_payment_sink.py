@@ -1,10 +1,9 @@
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
 from hotglue_models_accounting.accounting import BillPayment
 from target_dynamics_bc.client import DynamicsClient
 from target_dynamics_bc.mappers.bill_payment_schema_mapper import BillPaymentSchemaMapper
 from target_dynamics_bc.sinks.base_sinks import DynamicsBaseBatchSinkSingleUpsert
-from target_dynamics_bc.utils import extract_error_message
 
 
 class BillPaymentSink(DynamicsBaseBatchSinkSingleUpsert):
@@ -12,6 +11,7 @@ class BillPaymentSink(DynamicsBaseBatchSinkSingleUpsert):
     record_type = "vendorPayments"
     unified_schema = BillPayment
     auto_validate_unified_schema = True
+    reference_collections = ["dimensions"]
 
     def preprocess_batch(self, records: List[dict]):
         # get vendor payment journals for company, filter by id and code
@@ -19,11 +19,11 @@ class BillPaymentSink(DynamicsBaseBatchSinkSingleUpsert):
             {"field_from": "journalId", "field_to": "id", "should_quote": False},
             {"field_from": "journalExternalId", "field_to": "code", "should_quote": True}
         ]
-        existing_company_vendor_payment_journals = self.dynamics_client.get_existing_entities_for_records(
-            self._target.reference_data.get("companies", []),
+        existing_company_vendor_payment_journals = self.get_existing_entities_for_records(
             "vendorPaymentJournals",
             records,
-            vendor_payment_journal_filter_mappings
+            vendor_payment_journal_filter_mappings,
+            entity_cache=self._target.entity_cache
         )
 
         # get bills for company, filter by id, documentNumber
@@ -43,11 +43,11 @@ class BillPaymentSink(DynamicsBaseBatchSinkSingleUpsert):
             {"field_from": "billId", "field_to": "id", "should_quote": False},
             {"field_from": "billNumber", "field_to": "vendorInvoiceNumber", "should_quote": True},
         ]
-        existing_company_bills = self.dynamics_client.get_existing_entities_for_records(
-            self._target.reference_data.get("companies", []),
+        existing_company_bills = self.get_existing_entities_for_records(
             "purchaseInvoices",
             records,
-            bill_filter_mappings
+            bill_filter_mappings,
+            entity_cache=self._target.entity_cache
         )
 
         # get vendors for company, filter by id, number, displayName
@@ -56,11 +56,11 @@ class BillPaymentSink(DynamicsBaseBatchSinkSingleUpsert):
             {"field_from": "vendorNumber", "field_to": "number", "should_quote": True},
             {"field_from": "vendorName", "field_to": "displayName", "should_quote": True},
         ]
-        existing_company_vendors = self.dynamics_client.get_existing_entities_for_records(
-            self._target.reference_data.get("companies", []),
+        existing_company_vendors = self.get_existing_entities_for_records(
             "Vendors",
             records,
-            vendor_filter_mappings
+            vendor_filter_mappings,
+            entity_cache=self._target.entity_cache
         )
 
         self.reference_data = {**self._target.reference_data, self.name: existing_company_bill_payments, "Bills": existing_company_bills, "Vendors": existing_company_vendors, "VendorPaymentJournals": existing_company_vendor_payment_journals}
@@ -70,43 +70,56 @@ class BillPaymentSink(DynamicsBaseBatchSinkSingleUpsert):
         return BillPaymentSchemaMapper(record, self, self.reference_data).to_dynamics()
 
     def upsert_record(self, record: Dict) -> Tuple[str, bool, Dict]:
-        state = {}
-        payload = record["payload"]
-        
-        company_id = record["company_id"]
-        bill_payment_id = payload.pop("id", None)
-        journal_id = payload.pop("journalId")
-        is_update = bill_payment_id is not None
-        bill_payment_dimensions = payload.pop("dimensionSetLines", [])
+        return self.upsert_record_in_stages(record)
+
+    def upsert_records(self, records: List[Dict]) -> List[Union[Tuple[str, bool, Dict], Exception]]:
+        # staged_writes takes precedence over max_workers
+        if self.config.get("staged_writes"):
+            return self.upsert_records_in_stages(records)
+
+        return super().upsert_records(records)
+
+    def build_upsert(self, record: Dict) -> Dict:
+        bill_payment = super().build_upsert(record)
+        payload = bill_payment["payload"]
+        bill_payment["journal_id"] = payload.pop("journalId")
+        bill_payment["dimensions"] = payload.pop("dimensionSetLines", [])
+        return bill_payment
+
+    def get_upsert_stages(self):
+        return [
+            (self.build_bill_payment_requests, self.handle_bill_payment_responses),
+            (self.build_bill_payment_refetch_requests, self.handle_bill_payment_refetch_responses),
+            (self.build_bill_payment_dimensions_requests, self.handle_write_responses),
+        ]
 
+    def build_bill_payment_requests(self, bill_payment: Dict) -> List[dict]:
         # create/update bill payment
-        url_params = { "parentId": journal_id }
-        request_params = DynamicsClient.get_entity_upsert_request_params(self.record_type, company_id, bill_payment_id, url_params=url_params)
-        bill_payment_upsert_request_data = [{ **request_params, "body": payload }]
-        bill_payment_upsert_response = self.dynamics_client.make_batch_request(bill_payment_upsert_request_data)[0]
-
-        if bill_payment_upsert_response.get("status") not in [200, 201]:
-            state["error"] = extract_error_message(bill_payment_upsert_response)
-            return bill_payment_id, False, state
-        
-        bill_payment_id = bill_payment_upsert_response["body"]["id"]
-
-        # create/update bill dimensions
-        if bill_payment_dimensions:
-            # we have to re-fetch the bill payment otherwise we don't get the inherited dimensionSetLines from the Vendor
-            _, _, bill_payments = self.dynamics_client.get_entities(self.record_type, url_params={"companyId": company_id, "parentId": journal_id}, filters={"id": [bill_payment_id]}, expand="dimensionSetLines")
-            upserted_bill_payment = bill_payments[0]
-
-            existing_dimensions = upserted_bill_payment.get("dimensionSetLines", [])
-            bill_payment_dimensions_requests = DynamicsClient.create_dimension_set_lines_requests("vendorPaymentsDimensionSetLines", company_id, bill_payment_id, bill_payment_dimensions, existing_dimensions, parentId=journal_id)
-            bill_payment_dimensions_upsert_responses = self.dynamics_client.make_batch_request(bill_payment_dimensions_requests)
-
-            for bill_payment_dimensions_upsert_response in bill_payment_dimensions_upsert_responses:
-                if bill_payment_dimensions_upsert_response["status"] not in [200, 201]:
-                    state["error"] = extract_error_message(bill_payment_dimensions_upsert_response)
-                    return bill_payment_id, False, state
-
-        if is_update:
-            state["is_updated"] = True
-
-        return bill_payment_id, True, state
+        url_params = { "parentId": bill_payment["journal_id"] }
+        request_params = DynamicsClient.get_entity_upsert_request_params(self.record_type, bill_payment["company_id"], bill_payment["id"], url_params=url_params)
+        return [{ **request_params, "body": bill_payment["payload"] }]
+
+    def handle_bill_payment_responses(self, bill_payment: Dict, responses: List[dict]) -> Optional[str]:
+        error_message = self.handle_write_responses(bill_payment, responses)
+        if not error_message:
+            bill_payment["id"] = responses[0]["body"]["id"]
+        return error_message
+
+    def build_bill_payment_refetch_requests(self, bill_payment: Dict) -> List[dict]:
+        # we have to re-fetch the bill payment otherwise we don't get the inherited dimensionSetLines from the Vendor
+        if not bill_payment["dimensions"]:
+            return []
+        url_params = {"companyId": bill_payment["company_id"], "parentId": bill_payment["journal_id"]}
+        return self.build_refetch_requests(bill_payment, url_params, expand="dimensionSetLines")
+
+    def handle_bill_payment_refetch_responses(self, bill_payment: Dict, responses: List[dict]) -> Optional[str]:
+        upserted_bill_payment, error_message = self.get_refetched_entity(responses)
+        if upserted_bill_payment is not None:
+            bill_payment["existing_dimensions"] = upserted_bill_payment.get("dimensionSetLines", [])
+        return error_message
+
+    def build_bill_payment_dimensions_requests(self, bill_payment: Dict) -> List[dict]:
+        # create/update bill payment dimensions
+        if not bill_payment["dimensions"]:
+            return []
+        return DynamicsClient.create_dimension_set_lines_requests("vendorPaymentsDimensionSetLines", bill_payment["company_id"], bill_payment["id"], bill_payment["dimensions"], bill_payment["existing_dimensions"], parentId=bill_payment["journal_id"])
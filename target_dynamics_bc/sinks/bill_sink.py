@@ -1,4 +1,4 @@
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 from hotglue_models_accounting.accounting import Bill
 from target_dynamics_bc.client import DynamicsClient
@@ -12,6 +12,7 @@ class BillSink(DynamicsBaseBatchSinkSingleUpsert):
     record_type = "purchaseInvoices"
     unified_schema = Bill
     auto_validate_unified_schema = True
+    reference_collections = ["currencies", "dimensions", "accounts", "locations"]
 
     def preprocess_batch(self, records: List[dict]):
         # fetch reference data related to existing customers
@@ -21,12 +22,12 @@ class BillSink(DynamicsBaseBatchSinkSingleUpsert):
             {"field_from": "transactionNumber", "field_to": "number", "should_quote": True},
             {"field_from": "billNumber", "field_to": "vendorInvoiceNumber", "should_quote": True},
         ]
-        existing_company_bills = self.dynamics_client.get_existing_entities_for_records(
-            self._target.reference_data.get("companies", []),
+        existing_company_bills = self.get_existing_entities_for_records(
             self.record_type,
             records,
             bill_filter_mappings,
-            expand="dimensionSetLines, purchaseInvoiceLines($expand=dimensionSetLines)"
+            expand="dimensionSetLines, purchaseInvoiceLines($expand=dimensionSetLines)",
+            entity_cache=self._target.entity_cache
         )
 
         # get vendors for company, filter by id, number, displayName
@@ -35,11 +36,13 @@ class BillSink(DynamicsBaseBatchSinkSingleUpsert):
             {"field_from": "vendorNumber", "field_to": "number", "should_quote": True},
             {"field_from": "vendorName", "field_to": "displayName", "should_quote": True},
         ]
-        existing_company_vendors = self.dynamics_client.get_existing_entities_for_records(
-            self._target.reference_data.get("companies", []),
+        # the pipelined writer predicts the dimensions a new bill inherits from the vendor default dimensions
+        existing_company_vendors = self.get_existing_entities_for_records(
             "Vendors",
             records,
-            vendor_filter_mappings
+            vendor_filter_mappings,
+            expand="defaultDimensions" if self.config.get("pipelined_writes") else None,
+            entity_cache=self._target.entity_cache
         )
 
         # get items
@@ -55,11 +58,11 @@ class BillSink(DynamicsBaseBatchSinkSingleUpsert):
             {"field_from": "itemNumber", "field_to": "number", "should_quote": True},
             {"field_from": "itemName", "field_to": "displayName", "should_quote": True},
         ]
-        existing_company_items = self.dynamics_client.get_existing_entities_for_records(
-            self._target.reference_data.get("companies", []),
+        existing_company_items = self.get_existing_entities_for_records(
             "Items",
             sorted_items,
-            item_filter_mappings
+            item_filter_mappings,
+            entity_cache=self._target.entity_cache
         ) if items else []
 
         self.reference_data = {
@@ -74,155 +77,262 @@ class BillSink(DynamicsBaseBatchSinkSingleUpsert):
         return BillSchemaMapper(record, self, self.reference_data).to_dynamics()
 
     def upsert_record(self, record: Dict) -> Tuple[str, bool, Dict]:
-        state = {}
-        payload = record["payload"]
-        
+        existing_dimension_set_lines = record.pop("existing_dimension_set_lines", [])
+        existing_lines_dimension_set_lines = record.pop("existing_lines_dimension_set_lines", {})
+
+        self.check_bill_can_be_updated(record)
+
+        if self.config.get("pipelined_writes"):
+            requests_data, dimension_request_ids = self.build_pipelined_requests(record, existing_dimension_set_lines, existing_lines_dimension_set_lines)
+            # an atomic batch can't be split, bigger bills are upserted step by step
+            if len(requests_data) <= self.dynamics_client.max_batch_operations:
+                return self.upsert_record_pipelined(record, requests_data, dimension_request_ids)
+
+        return self.upsert_record_step_by_step(record)
+
+    def build_pipelined_requests(self, record: Dict, existing_dimension_set_lines: List[dict], existing_lines_dimension_set_lines: Dict[str, List[dict]]) -> Tuple[List[dict], Set[str]]:
+        """
+        Builds all the requests to upsert the bill, its lines and their dimensions and to post it,
+        to be sent in one atomic batch request. The requests depend on the request of the entity they
+        belong to, and new entities are referenced by their request id ($<request id>) as their ids
+        are only known once they are created.
+
+        The dimensions inherited by new bills and lines are predicted, if the prediction is wrong
+        the dimension requests fail and the batch is rolled back. Returns the requests and the ids
+        of the dimension requests
+        """
+        payload = dict(record["payload"])
         company_id = record["company_id"]
         bill_id = payload.pop("id", None)
-        is_update = bill_id is not None
-        is_draft = record.pop("is_draft", False)
         bill_dimensions = payload.pop("dimensionSetLines", [])
         bill_lines = payload.pop("purchaseInvoiceLines", [])
 
-        if is_update and record["status"] != "Draft":
-            raise InvalidRecordState(f"Cannot update a Bill that's not in Draft state")
+        requests_data = []
+        dimension_request_ids = set()
 
         # create/update bill
-        request_params = DynamicsClient.get_entity_upsert_request_params(self.record_type, company_id, bill_id)
-        bill_upsert_request_data = [{ **request_params, "body": payload }]
-        bill_upsert_response = self.dynamics_client.make_batch_request(bill_upsert_request_data)[0]
+        request_params = DynamicsClient.get_entity_upsert_request_params(self.record_type, company_id, bill_id, request_id="bill")
+        requests_data.append({ **request_params, "body": payload })
+        bill_url = request_params["url"] if bill_id else "$bill"
 
-        if bill_upsert_response.get("status") not in [200, 201]:
-            state["error"] = extract_error_message(bill_upsert_response)
-            return bill_id, False, state
-        
-        bill_id = bill_upsert_response["body"]["id"]
+        # create/update bill dimensions
+        bill_dimensions_requests = DynamicsClient.create_endpoint_dimension_set_lines_requests(f"{bill_url}/dimensionSetLines", bill_dimensions, existing_dimension_set_lines)
+        for index, request in enumerate(bill_dimensions_requests):
+            requests_data.append({ **request, "request_id": f"bill_dimension_{index}", "depends_on": ["bill"] })
+            dimension_request_ids.add(f"bill_dimension_{index}")
 
-        # we have to re-fetch the bill otherwise we don't get the inherited dimensionSetLines from the Vendor
-        _, _, bills = self.dynamics_client.get_entities(self.record_type, url_params={"companyId": company_id}, filters={"id": [bill_id]}, expand="dimensionSetLines")
-        upserted_bill = bills[0]
+        # lines are upserted after the bill dimensions so they inherit the final bill dimensions
+        bill_dimension_set_lines = existing_dimension_set_lines + [dimension for dimension in bill_dimensions if dimension["id"] not in {existing["id"] for existing in existing_dimension_set_lines}]
+        lines_depends_on = ["bill"] + [request["request_id"] for request in requests_data[1:]]
 
-        # create/update bill dimensions
-        if bill_dimensions:
-            existing_bill_dimensions = upserted_bill.get("dimensionSetLines", [])
-            bill_dimensions_requests = DynamicsClient.create_dimension_set_lines_requests("purchaseInvoicesDimensionSetLines", company_id, bill_id, bill_dimensions, existing_bill_dimensions)
-            bill_dimensions_upsert_responses = self.dynamics_client.make_batch_request(bill_dimensions_requests)
-
-            for bill_dimensions_upsert_response in bill_dimensions_upsert_responses:
-                if bill_dimensions_upsert_response["status"] not in [200, 201]:
-                    state["error"] = extract_error_message(bill_dimensions_upsert_response)
-                    return bill_id, False, state
-        
-        # if there is no bill lines to upsert we are done. Success!
-        if not bill_lines:
-            if is_update:
-                state["is_updated"] = True
-
-            return bill_id, True, state
-
-        # create/update lines       
-        bill_lines_dimensions = []
-        bill_lines_upsert_request_data = []
-        url_params = {"parentId": bill_id}
         for index, bill_line in enumerate(bill_lines):
+            bill_line = dict(bill_line)
             bill_line_id = bill_line.pop("id", None)
-            request_id = bill_line_id or f"temp_{index}"
             bill_line_dimensions = bill_line.pop("dimensionSetLines", [])
-            if bill_line_dimensions:
-                bill_lines_dimensions.append({
-                    "request_id": request_id,
-                    "dimension_set_lines": bill_line_dimensions
-                })
-
-            request_params = DynamicsClient.get_entity_upsert_request_params("purchaseInvoiceLines", company_id, entity_id=bill_line_id, url_params=url_params, request_id=request_id)
-            bill_lines_upsert_request_data.append({ **request_params, "body": bill_line })
-            
-        bill_lines_upsert_responses = self.dynamics_client.make_batch_request(bill_lines_upsert_request_data) if bill_lines_upsert_request_data else []
-        for bill_lines_upsert_response in bill_lines_upsert_responses:
-            if bill_lines_upsert_response.get("status") not in [200, 201]:
-                state["error"] = extract_error_message(bill_lines_upsert_response)
-                return bill_id, False, state
-
-
-        # if we sent locationId for any of the lines that lineType==Item we have to make another request to
-        # update unitCost and discountAmount because Dynamics will have overwritten that info with the Item
-        # Catalog info for that item
-        bill_lines_update_request_data = []
-        url_params = {"parentId": bill_id}
-        for index, bill_line in enumerate(bill_lines):
-            if not ("locationId" in bill_line and bill_line["lineType"] == "Item"):
-                continue
-
-            # if unitCost and discountAmount is not in the bill_line payload we have nothing to update
-            if "unitCost" not in bill_line and "discountAmount" not in bill_line:
-                continue
-
-            # get line ID from the previous upsert response
-            bill_line_id = bill_lines_upsert_responses[index]["body"]["id"]
-
-            bill_line_payload = {}
-            
-            if "unitCost" in bill_line:
-                bill_line_payload["unitCost"] = bill_line["unitCost"]
-
-            if "discountAmount" in bill_line:
-                bill_line_payload["discountAmount"] = bill_line["discountAmount"]
-
-            request_params = DynamicsClient.get_entity_upsert_request_params("purchaseInvoiceLines", company_id, entity_id=bill_line_id, url_params=url_params)
-            bill_lines_update_request_data.append({ **request_params, "body": bill_line_payload })
-
-        bill_lines_update_responses = self.dynamics_client.make_batch_request(bill_lines_update_request_data) if bill_lines_update_request_data else []
-        for bill_lines_update_response in bill_lines_update_responses:
-            if bill_lines_update_response.get("status") not in [200, 201]:
-                state["error"] = extract_error_message(bill_lines_update_response)
-                return bill_id, False, state
-
-        # upsert bill lines dimensions if there are any
-        if bill_lines_dimensions:
-            # we have to re-fetch the bill otherwise we don't get the inherited dimensionSetLines from the Vendor
-            _, _, bills = self.dynamics_client.get_entities(self.record_type, url_params={"companyId": company_id}, filters={"id": [bill_id]}, expand="dimensionSetLines, purchaseInvoiceLines($expand=dimensionSetLines)")
-            upserted_bill = bills[0]
+            line_request_id = f"line_{index}"
+
+            # create/update line
+            if bill_line_id:
+                requests_data.append({ "url": f"{bill_url}/purchaseInvoiceLines({bill_line_id})", "method": "PATCH", "body": bill_line, "request_id": line_request_id, "depends_on": lines_depends_on })
+                bill_line_url = f"{bill_url}/purchaseInvoiceLines({bill_line_id})"
+            else:
+                requests_data.append({ "url": f"{bill_url}/purchaseInvoiceLines", "method": "POST", "body": bill_line, "request_id": line_request_id, "depends_on": lines_depends_on })
+                bill_line_url = f"${line_request_id}"
+
+            # Dynamics overwrites unitCost and discountAmount with the Item Catalog info when the location
+            # is set for an Item line, so they have to be updated again
+            bill_line_payload = self.get_line_cost_payload(bill_line)
+            if bill_line_payload:
+                requests_data.append({ "url": bill_line_url, "method": "PATCH", "body": bill_line_payload, "request_id": f"{line_request_id}_cost", "depends_on": [line_request_id] })
+
+            # create/update line dimensions
+            existing_bill_line_dimensions = existing_lines_dimension_set_lines.get(bill_line_id, []) + bill_dimension_set_lines
+            bill_line_dimensions_requests = DynamicsClient.create_endpoint_dimension_set_lines_requests(f"{bill_line_url}/dimensionSetLines", bill_line_dimensions, existing_bill_line_dimensions)
+            for dimension_index, request in enumerate(bill_line_dimensions_requests):
+                requests_data.append({ **request, "request_id": f"{line_request_id}_dimension_{dimension_index}", "depends_on": [line_request_id] })
+                dimension_request_ids.add(f"{line_request_id}_dimension_{dimension_index}")
+
+        # POST the bill if is_draft is False, bills without lines are not posted (same as upsert_record_step_by_step)
+        if bill_lines and not record.get("is_draft", False):
+            requests_data.append({
+                "url": f"{bill_url}/Microsoft.NAV.post",
+                "method": "POST",
+                "request_id": "post",
+                "depends_on": [request["request_id"] for request in requests_data]
+            })
+
+        return requests_data, dimension_request_ids
+
+    def upsert_record_pipelined(self, record: Dict, requests_data: List[dict], dimension_request_ids: Set[str]) -> Tuple[str, bool, Dict]:
+        """
+        Upserts the bill with one atomic batch request. If a dimension request fails, which happens when
+        the inherited dimensions were not predicted correctly, the bill is upserted step by step instead
+        """
+        state = {}
+        bill_id = record["payload"].get("id")
 
-            # create/update lines dimensions
-            bill_lines_dimensions_requests = []
-            for bill_line_dimensions in bill_lines_dimensions:
-                request_id = bill_line_dimensions["request_id"]
-                bill_line_dimension_set_lines = bill_line_dimensions["dimension_set_lines"]
+        responses = self.dynamics_client.make_batch_request(requests_data, transaction_type="atomic")
 
-                if not bill_line_dimension_set_lines:
-                    continue
+        # the batch is rolled back if any request fails, the requests depending on it fail with 424 (Failed Dependency)
+        failed_responses = [response for response in responses if response.get("status", 500) >= 400]
+        if failed_responses:
+            failed_response = next((response for response in failed_responses if response.get("status") != 424), failed_responses[0])
 
-                bill_line_id = next(bill_line_upsert_response["body"]["id"] for bill_line_upsert_response in bill_lines_upsert_responses if bill_line_upsert_response["id"] == request_id)
+            if failed_response.get("id") in dimension_request_ids:
+                self.logger.warning(f"Pipelined upsert of bill failed when upserting dimensions, upserting it step by step. Error: {extract_error_message(failed_response)}")
+                return self.upsert_record_step_by_step(record)
 
-                upserted_bill_line = next((bill_line for bill_line in upserted_bill["purchaseInvoiceLines"] if bill_line["id"] == bill_line_id), None)
-                existing_bill_line_dimensions = upserted_bill_line.get("dimensionSetLines", [])
+            state["error"] = extract_error_message(failed_response)
+            return bill_id, False, state
 
-                bill_lines_dimensions_requests += DynamicsClient.create_dimension_set_lines_requests("purchaseInvoiceLinesDimensionSetLines", company_id, bill_line_id, bill_line_dimension_set_lines, existing_bill_line_dimensions)
-            
-            bill_lines_dimensions_upsert_responses = self.dynamics_client.make_batch_request(bill_lines_dimensions_requests)
+        bill_response = next((response for response in responses if response.get("id") == "bill"), None)
+        if bill_response is None:
+            state["error"] = "Dynamics did not return the response of the bill upsert request"
+            return bill_id, False, state
 
-            for bill_lines_dimensions_upsert_response in bill_lines_dimensions_upsert_responses:
-                if bill_lines_dimensions_upsert_response["status"] not in [200, 201]:
-                    state["error"] = extract_error_message(bill_lines_dimensions_upsert_response)
-                    return bill_id, False, state
+        if bill_id:
+            state["is_updated"] = True
 
-        # POST the bill if is_draft is False
-        if not is_draft:
-            post_bill_endpoint = DynamicsClient.ref_request_endpoints[self.record_type].format(companyId=company_id)
-            post_bill_endpoint = f"{post_bill_endpoint}({bill_id})/Microsoft.NAV.post"
-            request_params = {
-                "url": post_bill_endpoint,
-                "method": "POST"
-            }
+        return bill_response["body"]["id"], True, state
+
+    def upsert_record_step_by_step(self, record: Dict) -> Tuple[str, bool, Dict]:
+        return self.upsert_record_in_stages(record)
+
+    def upsert_records(self, records: List[Dict]) -> List[Union[Tuple[str, bool, Dict], Exception]]:
+        # staged_writes takes precedence over pipelined_writes and max_workers
+        if self.config.get("staged_writes"):
+            return self.upsert_records_in_stages(records)
+
+        return super().upsert_records(records)
+
+    def check_bill_can_be_updated(self, record: Dict):
+        if record["payload"].get("id") and record["status"] != "Draft":
+            raise InvalidRecordState("Cannot update a Bill that's not in Draft state")
+
+    def build_upsert(self, record: Dict) -> Dict:
+        # only used by the pipelined writer
+        record.pop("existing_dimension_set_lines", None)
+        record.pop("existing_lines_dimension_set_lines", None)
+        self.check_bill_can_be_updated(record)
+
+        bill = super().build_upsert(record)
+        payload = bill["payload"]
+        bill["is_draft"] = record.get("is_draft", False)
+        bill["dimensions"] = payload.pop("dimensionSetLines", [])
+
+        bill["lines"] = []
+        for bill_line in payload.pop("purchaseInvoiceLines", []):
+            bill_line = dict(bill_line)
+            bill["lines"].append({"id": bill_line.pop("id", None), "dimensions": bill_line.pop("dimensionSetLines", []), "payload": bill_line})
+
+        return bill
+
+    def get_upsert_stages(self):
+        return [
+            (self.build_bill_requests, self.handle_bill_responses),
+            (self.build_bill_refetch_requests, self.handle_bill_refetch_responses),
+            (self.build_bill_dimensions_requests, self.handle_write_responses),
+            (self.build_lines_requests, self.handle_lines_responses),
+            (self.build_lines_cost_requests, self.handle_write_responses),
+            (self.build_lines_refetch_requests, self.handle_lines_refetch_responses),
+            (self.build_lines_dimensions_requests, self.handle_write_responses),
+            (self.build_post_requests, self.handle_post_responses),
+        ]
 
-            post_bill_response = self.dynamics_client.make_batch_request([request_params])[0]
+    def build_bill_requests(self, bill: Dict) -> List[dict]:
+        # create/update bill
+        request_params = DynamicsClient.get_entity_upsert_request_params(self.record_type, bill["company_id"], bill["id"])
+        return [{ **request_params, "body": bill["payload"] }]
 
-            if post_bill_response.get("status") != 204:
-                state["error"] = extract_error_message(post_bill_response)
-                return bill_id, False, state
+    def handle_bill_responses(self, bill: Dict, responses: List[dict]) -> Optional[str]:
+        error_message = self.handle_write_responses(bill, responses)
+        if not error_message:
+            bill["id"] = responses[0]["body"]["id"]
+        return error_message
 
+    def build_bill_refetch_requests(self, bill: Dict) -> List[dict]:
+        # we have to re-fetch the bill otherwise we don't get the inherited dimensionSetLines from the Vendor
+        if not bill["dimensions"]:
+            return []
+        return self.build_refetch_requests(bill, {"companyId": bill["company_id"]}, expand="dimensionSetLines")
 
-        if is_update:
-            state["is_updated"] = True
+    def handle_bill_refetch_responses(self, bill: Dict, responses: List[dict]) -> Optional[str]:
+        upserted_bill, error_message = self.get_refetched_entity(responses)
+        if upserted_bill is not None:
+            bill["existing_dimensions"] = upserted_bill.get("dimensionSetLines", [])
+        return error_message
 
-        return bill_id, True, state
+    def build_bill_dimensions_requests(self, bill: Dict) -> List[dict]:
+        # create/update bill dimensions
+        if not bill["dimensions"]:
+            return []
+        return DynamicsClient.create_dimension_set_lines_requests("purchaseInvoicesDimensionSetLines", bill["company_id"], bill["id"], bill["dimensions"], bill["existing_dimensions"])
+
+    def build_lines_requests(self, bill: Dict) -> List[dict]:
+        # create/update lines
+        lines_requests = []
+        for bill_line in bill["lines"]:
+            request_params = DynamicsClient.get_entity_upsert_request_params("purchaseInvoiceLines", bill["company_id"], entity_id=bill_line["id"], url_params={"parentId": bill["id"]})
+            lines_requests.append({ **request_params, "body": bill_line["payload"] })
+        return lines_requests
+
+    def handle_lines_responses(self, bill: Dict, responses: List[dict]) -> Optional[str]:
+        error_message = self.handle_write_responses(bill, responses)
+        if not error_message:
+            # the responses are in the same order as the lines
+            for bill_line, response in zip(bill["lines"], responses):
+                bill_line["id"] = response["body"]["id"]
+        return error_message
+
+    @staticmethod
+    def get_line_cost_payload(bill_line: Dict) -> Dict:
+        """
+        If we sent locationId for a line with lineType==Item we have to make another request to update
+        unitCost and discountAmount because Dynamics will have overwritten that info with the Item Catalog
+        info for that item. Returns the payload of that request, empty if it's not needed
+        """
+        if not ("locationId" in bill_line and bill_line["lineType"] == "Item"):
+            return {}
+        return {key: bill_line[key] for key in ["unitCost", "discountAmount"] if key in bill_line}
+
+    def build_lines_cost_requests(self, bill: Dict) -> List[dict]:
+        lines_cost_requests = []
+        for bill_line in bill["lines"]:
+            bill_line_payload = self.get_line_cost_payload(bill_line["payload"])
+            if bill_line_payload:
+                request_params = DynamicsClient.get_entity_upsert_request_params("purchaseInvoiceLines", bill["company_id"], entity_id=bill_line["id"], url_params={"parentId": bill["id"]})
+                lines_cost_requests.append({ **request_params, "body": bill_line_payload })
+        return lines_cost_requests
+
+    def build_lines_refetch_requests(self, bill: Dict) -> List[dict]:
+        # we have to re-fetch the bill otherwise we don't get the inherited dimensionSetLines from the Vendor
+        if not any(bill_line["dimensions"] for bill_line in bill["lines"]):
+            return []
+        return self.build_refetch_requests(bill, {"companyId": bill["company_id"]}, expand="dimensionSetLines, purchaseInvoiceLines($expand=dimensionSetLines)")
+
+    def handle_lines_refetch_responses(self, bill: Dict, responses: List[dict]) -> Optional[str]:
+        upserted_bill, error_message = self.get_refetched_entity(responses)
+        if upserted_bill is not None:
+            upserted_lines = {upserted_line["id"]: upserted_line for upserted_line in upserted_bill.get("purchaseInvoiceLines", [])}
+            for bill_line in bill["lines"]:
+                bill_line["existing_dimensions"] = upserted_lines.get(bill_line["id"], {}).get("dimensionSetLines", [])
+        return error_message
+
+    def build_lines_dimensions_requests(self, bill: Dict) -> List[dict]:
+        # create/update lines dimensions
+        lines_dimensions_requests = []
+        for bill_line in bill["lines"]:
+            if bill_line["dimensions"]:
+                lines_dimensions_requests += DynamicsClient.create_dimension_set_lines_requests("purchaseInvoiceLinesDimensionSetLines", bill["company_id"], bill_line["id"], bill_line["dimensions"], bill_line["existing_dimensions"])
+        return lines_dimensions_requests
+
+    def build_post_requests(self, bill: Dict) -> List[dict]:
+        # POST the bill if is_draft is False, bills without lines are not posted
+        if not bill["lines"] or bill["is_draft"]:
+            return []
+
+        post_bill_endpoint = DynamicsClient.ref_request_endpoints[self.record_type].format(companyId=bill["company_id"])
+        return [{ "url": f"{post_bill_endpoint}({bill['id']})/Microsoft.NAV.post", "method": "POST" }]
+
+    def handle_post_responses(self, bill: Dict, responses: List[dict]) -> Optional[str]:
+        return self.handle_write_responses(bill, responses, success_statuses=(204,))
@@ -10,6 +10,7 @@ class CustomerSink(DynamicsBaseBatchSinkBatchUpsert):
     record_type = "Customers"
     unified_schema = Customer
     auto_validate_unified_schema = True
+    reference_collections = ["currencies", "paymentMethods", "dimensions"]
 
     def preprocess_batch(self, records: List[dict]):
         # fetch reference data related to existing customers
@@ -18,8 +19,7 @@ class CustomerSink(DynamicsBaseBatchSinkBatchUpsert):
             {"field_from": "customerNumber", "field_to": "number", "should_quote": True}
         ]
 
-        existing_company_customers = self.dynamics_client.get_existing_entities_for_records(
-            self._target.reference_data.get("companies", []),
+        existing_company_customers = self.get_existing_entities_for_records(
             self.record_type,
             records,
             filter_mappings,
@@ -33,7 +33,14 @@ class CustomerSink(DynamicsBaseBatchSinkBatchUpsert):
         mapped_record = CustomerSchemaMapper(record, self, self.reference_data)
         payload = mapped_record.to_dynamics()
 
+        # existing records that didn't change are not sent to Dynamics
+        if self.config.get("skip_unchanged_records") and mapped_record.drop_unchanged(payload):
+            return {"records": [], "id": payload["id"], "is_unchanged": True}
+
         request_params = DynamicsClient.get_entity_upsert_request_params(self.record_type, mapped_record.company["id"], payload.get("id"))
+        etag_headers = self.get_etag_headers(mapped_record.existing_record)
+        if etag_headers:
+            request_params["headers"] = etag_headers
 
         default_dimensions_requests = []
         if mapped_record.existing_record and payload.get("defaultDimensions"):
@@ -48,4 +55,4 @@ class CustomerSink(DynamicsBaseBatchSinkBatchUpsert):
         records = [{"payload": payload, "request_params": request_params }]
         records += default_dimensions_requests
 
-        return {"records": records}
+        return {"records": records, "company_id": mapped_record.company["id"]}
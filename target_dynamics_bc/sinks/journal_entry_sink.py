@@ -12,6 +12,7 @@ class JournalEntrySink(DynamicsBaseBatchSinkSingleUpsert):
     record_type = "Journals"
     unified_schema = JournalEntry
     auto_validate_unified_schema = True
+    reference_collections = ["dimensions", "accounts"]
 
     def preprocess_batch(self, records: List[Dict]):
         # fetch existing Journals
@@ -19,11 +20,11 @@ class JournalEntrySink(DynamicsBaseBatchSinkSingleUpsert):
             {"field_from": "journalEntryNumber", "field_to": "displayName", "should_quote": True}
         ]
 
-        existing_company_journals = self.dynamics_client.get_existing_entities_for_records(
-            self._target.reference_data.get("companies", []),
+        existing_company_journals = self.get_existing_entities_for_records(
             self.record_type,
             records,
-            filter_mappings
+            filter_mappings,
+            entity_cache=self._target.entity_cache
         )
 
         self.reference_data = {**self._target.reference_data, self.name: existing_company_journals}
@@ -10,6 +10,10 @@ class VendorSink(DynamicsBaseBatchSinkBatchUpsert):
     record_type = "Vendors"
     unified_schema = Vendor
     auto_validate_unified_schema = True
+    reference_collections = ["currencies", "dimensions"]
+    cache_upserted_entities = True
+    # the bills and bill payments look vendors up by id, number and displayName
+    cached_filter_fields = {"id": False, "number": True, "displayName": True}
 
     def preprocess_batch(self, records: List[dict]):
         # fetch reference data related to existing vendors
@@ -18,8 +22,7 @@ class VendorSink(DynamicsBaseBatchSinkBatchUpsert):
             {"field_from": "vendorNumber", "field_to": "number", "should_quote": True}
         ]
 
-        existing_company_vendors = self.dynamics_client.get_existing_entities_for_records(
-            self._target.reference_data.get("companies", []),
+        existing_company_vendors = self.get_existing_entities_for_records(
             self.record_type,
             records,
             filter_mappings,
@@ -33,7 +36,14 @@ class VendorSink(DynamicsBaseBatchSinkBatchUpsert):
         mapped_record = VendorSchemaMapper(record, self, self.reference_data)
         payload = mapped_record.to_dynamics()
 
+        # existing records that didn't change are not sent to Dynamics
+        if self.config.get("skip_unchanged_records") and mapped_record.drop_unchanged(payload):
+            return {"records": [], "id": payload["id"], "is_unchanged": True}
+
         request_params = DynamicsClient.get_entity_upsert_request_params(self.record_type, mapped_record.company["id"], payload.get("id"))
+        etag_headers = self.get_etag_headers(mapped_record.existing_record)
+        if etag_headers:
+            request_params["headers"] = etag_headers
 
         default_dimensions_requests = []
         if mapped_record.existing_record and payload.get("defaultDimensions"):
@@ -48,4 +58,4 @@ class VendorSink(DynamicsBaseBatchSinkBatchUpsert):
         records = [{"payload": payload, "request_params": request_params }]
         records += default_dimensions_requests
 
-        return {"records": records}
+        return {"records": records, "company_id": mapped_record.company["id"]}
@@ -1,17 +1,23 @@
 """DynamicsV2 target class."""
 import json
 import os
+import threading
+from typing import Dict, List, Optional
 
 from singer_sdk import typing as th
 from target_hotglue.target import TargetHotglue
 
+from target_dynamics_bc.async_client import AsyncDynamicsClient
 from target_dynamics_bc.client import DynamicsClient
+from target_dynamics_bc.idempotency_store import IdempotencyStore
+from target_dynamics_bc.reference_cache import ReferenceDataCache
 from target_dynamics_bc.sinks.bill_payment_sink import BillPaymentSink
 from target_dynamics_bc.sinks.bill_sink import BillSink
 from target_dynamics_bc.sinks.customer_sink import CustomerSink
 from target_dynamics_bc.sinks.journal_entry_sink import JournalEntrySink
 from target_dynamics_bc.sinks.vendor_sink import VendorSink
-from target_dynamics_bc.utils import ReferenceData, DimensionDefinitionNotFound, InvalidConfigurationError
+from target_dynamics_bc.mappers.base_mappers import BaseMapper
+from target_dynamics_bc.utils import EntityCache, EntityIndexCache, LazyCompany, ReferenceData, DimensionDefinitionNotFound, InvalidConfigurationError
 
 class TargetDynamicsV2(TargetHotglue):
     """Sample target for DynamicsV2."""
@@ -38,22 +44,151 @@ class TargetDynamicsV2(TargetHotglue):
         )
 
         self.dynamics_client = DynamicsClient(self)
-        self.reference_data: ReferenceData = self.get_reference_data()
+        # the event loop and the session of the async client are kept for the whole run
+        self.async_client = AsyncDynamicsClient(self.dynamics_client) if self.config.get("use_async_client") else None
+        self.idempotency_store = self.get_idempotency_store()
+        self.entity_cache = self.get_entity_cache()
+        # the mapping is validated for the companies when their dimensions are loaded
         self.dimensions_mapping = self.load_fields_and_dimensions_mapping_config()
+        self.reference_data: ReferenceData = self.get_reference_data()
+
+    def _process_endofpipe(self) -> None:
+        try:
+            super()._process_endofpipe()
+        finally:
+            # release the pooled connections once all the sinks have been drained
+            if self.async_client:
+                self.async_client.close()
+            self.dynamics_client.close()
+            if self.entity_cache:
+                self.logger.info(f"Entity cache metrics: {self.entity_cache.get_metrics()}")
+            if self.reference_data_cache:
+                self.save_reference_data_cache()
+            if self.idempotency_store:
+                self.idempotency_store.compact()
+                self.idempotency_store.close()
 
     def get_reference_data(self) -> ReferenceData:
         self.logger.info(f"Getting reference data...")
 
         reference_data: ReferenceData = ReferenceData()
-        _, _, companies = self.dynamics_client.get_companies()
-        reference_data["companies"] = companies
 
-        self.logger.info(f"Done getting reference data...")
+        self.reference_data_cache = self.get_reference_data_cache()
+        cached_companies = self.reference_data_cache.load() if self.reference_data_cache else None
+        if cached_companies is not None:
+            self.logger.info(f"Revalidating cached reference data...")
+
+        # only the companies are loaded now, the reference data collections needed by the streams are
+        # loaded for all the companies when their schema message is received or, with lazy_reference_data,
+        # for each company the first time it's used. The cache is saved at the end of the run
+        self._cached_companies_by_id = {company["id"]: company for company in cached_companies or []}
+        self._reference_data_lock = threading.RLock()
+        self.schema_streams = set()
+
+        _, _, companies = self.dynamics_client.get_companies(cached_companies, load_reference_data=False)
+        collections = list(self.dynamics_client.company_reference_collections.keys())
+        reference_data["companies"] = [LazyCompany(company, collections, self.load_companies_reference_data) for company in companies]
+
+        self.logger.info(f"Done getting companies...")
         return reference_data
 
-    def validate_dimensions_mapping(self, dimensions_mapping: dict):
-        # for every company check if the dimension exists
+    def _process_schema_message(self, message_dict: dict) -> None:
+        self.schema_streams.add(message_dict["stream"])
+        # the dimension mappings of all the companies are validated before the sink is built
+        if not self.config.get("lazy_reference_data"):
+            self.load_companies_reference_data(self.reference_data["companies"])
+
+        super()._process_schema_message(message_dict)
+
+    def get_reference_collections(self) -> List[str]:
+        """Returns the reference data collections needed by the streams received so far"""
+        sink_types = [sink_type for sink_type in self.SINK_TYPES if sink_type.name in self.schema_streams]
+        if not sink_types or any(sink_type.reference_collections is None for sink_type in sink_types):
+            return list(self.dynamics_client.company_reference_collections.keys())
+
+        return list(dict.fromkeys(collection for sink_type in sink_types for collection in sink_type.reference_collections))
+
+    def load_companies_reference_data(self, companies: List[LazyCompany], collections: Optional[List[str]] = None):
+        """
+        Loads the reference data collections needed by the streams, and the given collections,
+        that are not loaded yet for the companies
+        """
+        # records can be mapped and upserted by several threads
+        with self._reference_data_lock:
+            collections = list(dict.fromkeys((collections or []) + self.get_reference_collections()))
+            missing_collections = {collection for company in companies for collection in company.get_missing_collections(collections)}
+            companies = [company for company in companies if company.get_missing_collections(collections)]
+            if not companies:
+                return
+
+            missing_collections = [collection for collection in collections if collection in missing_collections]
+            self.logger.info(f"Getting {missing_collections} reference data for companyIds={[company['id'] for company in companies]}...")
+            self.dynamics_client.load_companies_reference_data(companies, self._cached_companies_by_id, missing_collections)
+
+            if "dimensions" in missing_collections:
+                self.validate_dimensions_mapping(self.dimensions_mapping, companies)
+
+    def prefetch_reference_data(self, records: List[Dict]):
+        """Loads together the reference data of all the companies the records belong to"""
+        companies = self.reference_data.get("companies", [])
+        collections = self.get_reference_collections()
+        if not any(company.get_missing_collections(collections) for company in companies):
+            return
+
+        entity_index_cache = EntityIndexCache()
+        records_companies = {}
+        for record in records:
+            company = BaseMapper.get_company_from_record(companies, record, entity_index_cache)
+            if company is not None:
+                records_companies[company["id"]] = company
+
+        self.load_companies_reference_data(list(records_companies.values()))
+
+    def save_reference_data_cache(self):
+        """
+        Saves the reference data loaded in this run, the collections that were not loaded keep
+        the data that was cached for them
+        """
+        companies = []
         for company in self.reference_data["companies"]:
+            cached_company = self._cached_companies_by_id.get(company["id"], {})
+            cached_collections = {collection: cached_company[collection] for collection in company.get_missing_collections(company.collections) if collection in cached_company}
+            companies.append({**company, **cached_collections})
+
+        self.reference_data_cache.save(companies)
+
+    def get_reference_data_cache(self) -> Optional[ReferenceDataCache]:
+        """The reference data is only cached when there is a snapshot directory and a ttl is configured"""
+        snapshot_directory = self.config.get("snapshot_dir", None)
+        ttl = self.config.get("reference_data_cache_ttl")
+
+        if not snapshot_directory or not ttl:
+            return None
+
+        return ReferenceDataCache(snapshot_directory, self.dynamics_client.url, int(ttl))
+
+    def get_idempotency_store(self) -> Optional[IdempotencyStore]:
+        """Records already applied in previous runs are only tracked when there is a snapshot directory and a ttl is configured"""
+        snapshot_directory = self.config.get("snapshot_dir", None)
+        ttl = self.config.get("idempotency_store_ttl")
+
+        if not snapshot_directory or not ttl:
+            return None
+
+        return IdempotencyStore(snapshot_directory, self.dynamics_client.url, int(ttl))
+
+    def get_entity_cache(self) -> Optional[EntityCache]:
+        """Entities looked up by the sinks are only cached across batches and streams when a max size is configured"""
+        max_size = self.config.get("entity_cache_size")
+
+        if not max_size:
+            return None
+
+        return EntityCache(int(max_size))
+
+    def validate_dimensions_mapping(self, dimensions_mapping: dict, companies: List[Dict]):
+        # for every company check if the dimension exists
+        for company in companies:
             self.logger.info(f"Validating field -> dimension mapping for companyId={company['id']}")
             for dimension_name in dimensions_mapping.values():
                 found_dimension = next((dimension for dimension in company["dimensions"] if dimension["code"] == dimension_name), None)
@@ -91,7 +226,6 @@ class TargetDynamicsV2(TargetHotglue):
             raise InvalidConfigurationError("dynamics-bc is not provided in the tenant-config.json")
 
         dimensions_mapping = dynamics_config.get("dimension_mappings", {})
-        self.validate_dimensions_mapping(dimensions_mapping)
 
         return dimensions_mapping
 
@@ -0,0 +1,101 @@
+"""Tests for the base sinks batch helpers."""
+
+from target_dynamics_bc.sinks.base_sinks import DynamicsBaseBatchSinkBatchUpsert, DynamicsBaseBatchSinkSingleUpsert
+
+
+def build_atomicity_groups_requests(records):
+    requests_data = []
+    for record in records:
+        atomicity_group = f"record_{record['raw_record_index']}"
+        for index in range(len(record["records"])):
+            requests_data.append({"request_id": f"{atomicity_group}_{index}", "atomicity_group": atomicity_group})
+    return requests_data
+
+
+def test_group_responses_by_record():
+    records = [{"raw_record_index": 2, "records": [{}, {}]}, {"raw_record_index": 5, "records": [{}]}]
+    requests_data = build_atomicity_groups_requests(records)
+    # responses of a batch are not in the order of the requests
+    responses = [
+        {"id": "record_5_0", "status": 201},
+        {"id": "record_2_1", "status": 424},
+        {"id": "record_2_0", "status": 400},
+    ]
+
+    records_responses = DynamicsBaseBatchSinkBatchUpsert.group_responses_by_record(records, requests_data, responses)
+
+    assert records_responses == [
+        [{"id": "record_2_0", "status": 400}, {"id": "record_2_1", "status": 424}],
+        [{"id": "record_5_0", "status": 201}],
+    ]
+
+
+def test_group_responses_by_record_with_missing_response():
+    records = [{"raw_record_index": 0, "records": [{}, {}]}, {"raw_record_index": 1, "records": [{}]}]
+    requests_data = build_atomicity_groups_requests(records)
+    responses = [{"id": "record_0_0", "status": 200}, {"id": "record_1_0", "status": 200}]
+
+    records_responses = DynamicsBaseBatchSinkBatchUpsert.group_responses_by_record(records, requests_data, responses)
+
+    # the record missing a response fails, the other records are not affected
+    assert records_responses[0][0] == {"id": "record_0_0", "status": 200}
+    assert records_responses[0][1]["status"] == 500
+    assert records_responses[1] == [{"id": "record_1_0", "status": 200}]
+
+
+class StagedSink(DynamicsBaseBatchSinkSingleUpsert):
+    """Creates the entity and then its children, the children of failed entities are not created"""
+    name = "Staged"
+    record_type = "Vendors"
+    preprocess_batch = process_batch_record = upsert_record = None
+
+    def __init__(self):
+        self.batches = []
+
+    def make_staged_batch_request(self, stage_requests):
+        self.batches.append(stage_requests)
+        return {
+            index: [{"status": 400, "body": "failed"} if request["body"].get("fail") else {"status": 201, "body": {"id": f"id_{index}"}} for request in requests_data]
+            for index, requests_data in stage_requests.items()
+        }
+
+    def get_upsert_stages(self):
+        return [(self.build_entity_requests, self.handle_entity_responses), (self.build_children_requests, self.handle_write_responses)]
+
+    def build_entity_requests(self, upsert):
+        return [{"url": "entities", "method": "POST", "body": upsert["payload"]}]
+
+    def handle_entity_responses(self, upsert, responses):
+        error_message = self.handle_write_responses(upsert, responses)
+        if not error_message:
+            upsert["id"] = responses[0]["body"]["id"]
+        return error_message
+
+    def build_children_requests(self, upsert):
+        if upsert["id"] == "id_2":
+            raise ValueError("invalid child")
+        return [{"url": f"entities({upsert['id']})/children", "method": "POST", "body": child} for child in upsert["payload"].get("children", [])]
+
+
+def test_upsert_records_in_stages():
+    sink = StagedSink()
+    records = [
+        {"company_id": "1", "payload": {"children": [{}, {"fail": True}]}},
+        {"company_id": "1", "payload": {"fail": True, "children": [{}]}},
+        {"company_id": "1", "payload": {"children": [{}]}},
+        {"company_id": "1", "payload": {"id": "existing"}},
+        {"payload": {}},
+    ]
+
+    results = sink.upsert_records_in_stages(records)
+
+    # the requests of each stage are sent together, records without requests skip the stage
+    assert [list(stage_requests.keys()) for stage_requests in sink.batches] == [[0, 1, 2, 3], [0]]
+    # records failing in a later stage keep the id of the entity created
+    assert results[:4] == [
+        ("id_0", False, {"error": "failed"}),
+        (None, False, {"error": "failed"}),
+        ("id_2", False, {"error": "invalid child"}),
+        ("id_3", True, {"is_updated": True}),
+    ]
+    assert isinstance(results[4], KeyError)
@@ -0,0 +1,121 @@
+"""Tests for the DynamicsClient batch request helpers."""
+
+import pytest
+
+from target_dynamics_bc.client import DynamicsClient
+
+
+@pytest.fixture
+def client():
+    # the batch helpers don't use the auth or the session, the client is created without a target
+    client = DynamicsClient.__new__(DynamicsClient)
+    client.max_batch_operations = 3
+    return client
+
+
+def build_requests(count, **requests_options):
+    return [
+        {"url": f"entities({index})", "method": "PATCH", "request_id": str(index), **requests_options.get(str(index), {})}
+        for index in range(count)
+    ]
+
+
+def get_chunks_ids(chunks):
+    return [[request["request_id"] for request in chunk] for chunk in chunks]
+
+
+def test_chunk_batch_requests_splits_by_max_operations(client):
+    chunks = client.chunk_batch_requests(build_requests(7), "non_atomic")
+
+    assert get_chunks_ids(chunks) == [["0", "1", "2"], ["3", "4", "5"], ["6"]]
+
+
+def test_chunk_batch_requests_keeps_atomic_batch_together(client):
+    chunks = client.chunk_batch_requests(build_requests(7), "atomic")
+
+    assert get_chunks_ids(chunks) == [["0", "1", "2", "3", "4", "5", "6"]]
+
+
+def test_chunk_batch_requests_keeps_dependent_requests_together(client):
+    # 3 depends on 2, the chunk can't end between them
+    requests_data = build_requests(6, **{"3": {"depends_on": ["2"]}})
+
+    chunks = client.chunk_batch_requests(requests_data, "non_atomic")
+
+    assert get_chunks_ids(chunks) == [["0", "1"], ["2", "3", "4"], ["5"]]
+
+
+def test_chunk_batch_requests_exceeds_max_operations_for_long_dependency_chains(client):
+    # every request depends on the previous one, the chain can't be split
+    requests_data = build_requests(5, **{str(index): {"depends_on": [str(index - 1)]} for index in range(1, 5)})
+
+    chunks = client.chunk_batch_requests(requests_data, "non_atomic")
+
+    assert get_chunks_ids(chunks) == [["0", "1", "2", "3", "4"]]
+
+
+def test_chunk_batch_requests_keeps_atomicity_groups_together(client):
+    group = {"atomicity_group": "record_1"}
+    requests_data = build_requests(6, **{"2": group, "3": group, "4": group})
+
+    chunks = client.chunk_batch_requests(requests_data, "non_atomic")
+
+    assert get_chunks_ids(chunks) == [["0", "1"], ["2", "3", "4"], ["5"]]
+
+
+def test_chunk_batch_requests_ignores_dependencies_outside_the_batch(client):
+    requests_data = build_requests(4, **{"1": {"depends_on": ["missing"]}})
+
+    chunks = client.chunk_batch_requests(requests_data, "non_atomic")
+
+    assert get_chunks_ids(chunks) == [["0", "1", "2"], ["3"]]
+
+
+def test_get_retry_requests_rewrites_references_to_created_entities():
+    requests_data = [
+        {"url": "companies(1)/purchaseInvoices", "method": "POST", "request_id": "bill"},
+        {"url": "$bill/purchaseInvoiceLines", "method": "POST", "request_id": "line", "depends_on": ["bill"]},
+    ]
+    responses = [
+        {"id": "bill", "status": 201, "headers": {"location": "https://bc/companies(1)/purchaseInvoices(10)"}},
+        {"id": "line", "status": 429},
+    ]
+
+    retry_requests = DynamicsClient.get_retry_requests(requests_data, responses, {"line"})
+
+    assert retry_requests == [
+        {"url": "https://bc/companies(1)/purchaseInvoices(10)/purchaseInvoiceLines", "method": "POST", "request_id": "line", "depends_on": []}
+    ]
+
+
+def test_get_retry_requests_retries_dependent_requests():
+    requests_data = [
+        {"url": "companies(1)/purchaseInvoices", "method": "POST", "request_id": "bill"},
+        {"url": "$bill/purchaseInvoiceLines", "method": "POST", "request_id": "line", "depends_on": ["bill"]},
+        {"url": "companies(1)/vendors", "method": "POST", "request_id": "vendor"},
+    ]
+    responses = [{"id": "bill", "status": 429}, {"id": "line", "status": 424}, {"id": "vendor", "status": 201}]
+
+    retry_requests = DynamicsClient.get_retry_requests(requests_data, responses, {"bill"})
+
+    # the line still references the bill, which is retried in the same batch
+    assert retry_requests == requests_data[:2]
+
+
+def test_get_retry_requests_retries_whole_atomicity_group():
+    requests_data = [
+        {"url": "vendors(1)", "method": "PATCH", "request_id": "record_1_0", "atomicity_group": "record_1"},
+        {"url": "vendors(1)/defaultDimensions", "method": "POST", "request_id": "record_1_1", "atomicity_group": "record_1"},
+        {"url": "vendors(2)", "method": "PATCH", "request_id": "record_2_0", "atomicity_group": "record_2"},
+    ]
+    responses = [{"id": "record_1_0", "status": 200}, {"id": "record_1_1", "status": 429}, {"id": "record_2_0", "status": 200}]
+
+    retry_requests = DynamicsClient.get_retry_requests(requests_data, responses, {"record_1_1"})
+
+    assert [request["request_id"] for request in retry_requests] == ["record_1_0", "record_1_1"]
+
+
+def test_gateway_timeouts_and_writes_are_not_retried():
+    assert 504 not in DynamicsClient.retryable_status_codes
+    assert DynamicsClient.is_read_only_batch([{"url": "vendors", "method": "GET"}])
+    assert not DynamicsClient.is_read_only_batch([{"url": "vendors", "method": "GET"}, {"url": "vendors", "method": "POST"}])
@@ -0,0 +1,53 @@
+"""Tests for the adaptive rate limiter."""
+
+import time
+
+import pytest
+
+from target_dynamics_bc.rate_limiter import AdaptiveRateLimiter
+
+
+def test_rate_limiter_without_rate_does_not_pace():
+    limiter = AdaptiveRateLimiter("env", None, min_rate=0.5, max_rate=20)
+
+    assert all(limiter.try_acquire() == 0 for _ in range(100))
+    limiter.on_throttle()
+    limiter.on_success()
+
+    assert limiter.get_metrics()["requests"] == 100
+    assert limiter.get_metrics()["throttled"] == 1
+    assert limiter.get_metrics()["rate"] is None
+
+
+def test_rate_limiter_keeps_rate_within_limits():
+    limiter = AdaptiveRateLimiter("env", 100, min_rate=0.5, max_rate=20)
+    assert limiter.rate == 20
+
+    for _ in range(20):
+        limiter.on_throttle()
+    assert limiter.rate == 0.5
+
+    # the wait for the next token is finite at the min rate
+    assert 0 < limiter.try_acquire() <= 2
+
+
+@pytest.mark.parametrize("rate, min_rate, max_rate", [(-1, 0.5, 20), (10, 0, 20), (10, 5, 1)])
+def test_rate_limiter_rejects_invalid_limits(rate, min_rate, max_rate):
+    with pytest.raises(ValueError):
+        AdaptiveRateLimiter("env", rate, min_rate=min_rate, max_rate=max_rate)
+
+
+def test_rate_limiter_measures_the_time_waited():
+    limiter = AdaptiveRateLimiter("env", 10, min_rate=0.5, max_rate=20)
+    limiter.acquire()
+    assert limiter.get_metrics()["waited_seconds"] == 0
+
+    # planning a wait doesn't count as waiting
+    limiter.try_acquire()
+    assert limiter.waited_seconds == 0
+
+    start = time.monotonic()
+    limiter.acquire()
+    elapsed = time.monotonic() - start
+
+    assert 0 < limiter.waited_seconds <= elapsed
@@ -0,0 +1,62 @@
+"""Tests for the utils caches."""
+
+from target_dynamics_bc.utils import EntityCache
+
+
+def test_entity_cache_evicts_least_recently_used():
+    cache = EntityCache(2)
+    cache.put_entities("Vendors", "C", [{"id": "v1"}, {"id": "v2"}])
+
+    # v1 is used, so v2 is the least recently used
+    assert cache.get_entity("Vendors", "C", "v1") == {"id": "v1"}
+    cache.put_entities("Vendors", "C", [{"id": "v3"}])
+
+    assert cache.get_entity("Vendors", "C", "v2") is None
+    assert cache.get_entity("Vendors", "C", "v1") == {"id": "v1"}
+    assert cache.get_entity("Vendors", "C", "v3") == {"id": "v3"}
+
+
+def test_entity_cache_eviction_drops_filter_keys():
+    cache = EntityCache(2)
+    cache.put_entities("Vendors", "C", [{"id": "v1"}, {"id": "v2"}])
+    cache.put_filter_ids("Vendors", "C", "displayName", "'Acme'", ["v1", "v2"])
+    cache.put_filter_ids("Vendors", "C", "number", "'V2'", ["v2"])
+
+    cache.put_entities("Vendors", "C", [{"id": "v3"}])
+
+    # v1 was evicted, the filter value it matched can't be answered without it
+    assert cache.get_filter_ids("Vendors", "C", "displayName", "'Acme'") is None
+    assert cache.get_filter_ids("Vendors", "C", "number", "'V2'") == ["v2"]
+
+
+def test_entity_cache_does_not_cache_filter_ids_of_evicted_entities():
+    cache = EntityCache(1)
+    cache.put_entities("Vendors", "C", [{"id": "v1"}, {"id": "v2"}])
+
+    cache.put_filter_ids("Vendors", "C", "displayName", "'Acme'", ["v1", "v2"])
+
+    assert cache.get_filter_ids("Vendors", "C", "displayName", "'Acme'") is None
+
+
+def test_entity_cache_write_through():
+    cache = EntityCache(10)
+    cache.put_entities("Vendors", "C", [{"id": "v1", "displayName": "Acme"}], expand="defaultDimensions")
+    cache.put_filter_ids("Vendors", "C", "displayName", "'Acme'", ["v1"])
+
+    cache.write("Vendors", "C", {"id": "v2", "number": "V2", "displayName": "Acme"}, {"id": "v2", "number": "'V2'", "displayName": "'Acme'"})
+
+    assert cache.get_filter_ids("Vendors", "C", "number", "'V2'") == ["v2"]
+    assert cache.get_filter_ids("Vendors", "C", "displayName", "'Acme'") == ["v1", "v2"]
+    # the written entity only answers lookups without $expand
+    assert cache.get_entity("Vendors", "C", "v2") == {"id": "v2", "number": "V2", "displayName": "Acme"}
+    assert cache.get_entity("Vendors", "C", "v2", expand="defaultDimensions") is None
+
+
+def test_entity_cache_invalidate():
+    cache = EntityCache(10)
+    cache.write("Bills", "C", {"id": "b1", "number": "B1"}, {"id": "b1", "number": "'B1'"})
+
+    cache.invalidate("Bills", "C", "b1")
+
+    assert cache.get_entity("Bills", "C", "b1") is None
+    assert cache.get_filter_ids("Bills", "C", "number", "'B1'") is None
@@ -1,5 +1,7 @@
 import json
-from typing import List, Optional
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from typing_extensions import TypedDict
 
 from target_hotglue.common import HGJSONEncoder
@@ -21,6 +23,203 @@ def extract_error_message(response: dict) -> Optional[str]:
         return json.dumps(error, cls=HGJSONEncoder)
     return str(error)
 
+class EntityIndex:
+    """
+    Hash indexes over a list of entities by the given fields, so entities can be found by
+    field value in constant time instead of scanning the list
+    """
+    def __init__(self, entities: List[dict], fields: Tuple[str, ...]) -> None:
+        self._indexes: Dict[str, Dict[Any, List[Tuple[int, dict]]]] = {field: {} for field in fields}
+
+        for position, entity in enumerate(entities):
+            for field in fields:
+                value = entity.get(field)
+                if value is None:
+                    continue
+                try:
+                    self._indexes[field].setdefault(value, []).append((position, entity))
+                except TypeError:
+                    # unhashable values can't be looked up
+                    continue
+
+    def _get_matches(self, field: str, value: Any) -> List[Tuple[int, dict]]:
+        if value is None:
+            return []
+        try:
+            return self._indexes[field].get(value, [])
+        except TypeError:
+            return []
+
+    def get(self, field: str, value: Any) -> Optional[dict]:
+        """Returns the first entity where field == value"""
+        matches = self._get_matches(field, value)
+        return matches[0][1] if matches else None
+
+    def get_all(self, field: str, value: Any) -> List[dict]:
+        """Returns all the entities where field == value, in the order of the list"""
+        return [entity for _, entity in self._get_matches(field, value)]
+
+    def find_first(self, **values) -> Optional[dict]:
+        """Returns the first entity in the list that matches any of the field values"""
+        matches = [self._get_matches(field, value)[0] for field, value in values.items() if self._get_matches(field, value)]
+        return min(matches, key=lambda match: match[0])[1] if matches else None
+
+class EntityIndexCache:
+    """Caches the EntityIndex of each list of entities, so each index is built only once"""
+    def __init__(self) -> None:
+        self._indexes: Dict[Tuple[int, Tuple[str, ...]], Tuple[List[dict], int, EntityIndex]] = {}
+
+    def get_index(self, entities: List[dict], fields: Tuple[str, ...]) -> EntityIndex:
+        key = (id(entities), fields)
+        cached = self._indexes.get(key)
+        # the list is kept in the cache so its id can't be reused by another list,
+        # and the index is rebuilt if entities were added to it
+        if cached and cached[0] is entities and cached[1] == len(entities):
+            return cached[2]
+
+        index = EntityIndex(entities, fields)
+        self._indexes[key] = (entities, len(entities), index)
+        return index
+
+    def clear(self):
+        self._indexes = {}
+
+class LookupCache:
+    """
+    Memoizes the result of reference lookups keyed by (entity type, company id, lookup values),
+    so a lookup repeated by the records and lines of a batch is resolved only once.
+    Lookups that found nothing are memoized too
+    """
+    def __init__(self) -> None:
+        self._results: Dict[Tuple, Optional[dict]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_resolve(self, key: Tuple, resolve: Callable[[], Optional[dict]]) -> Optional[dict]:
+        try:
+            if key in self._results:
+                self.hits += 1
+                return self._results[key]
+        except TypeError:
+            # unhashable lookup values can't be memoized
+            return resolve()
+
+        self.misses += 1
+        result = resolve()
+        self._results[key] = result
+        return result
+
+    def get_metrics(self) -> Dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._results)}
+
+    def clear(self):
+        self._results = {}
+        self.hits = 0
+        self.misses = 0
+
+class EntityCache:
+    """
+    Run-scoped LRU cache of the entities fetched from Dynamics, shared by all the sinks so entities
+    looked up by every batch (vendors, items, bills, journals) are only fetched once per run.
+
+    Entities are cached per (record type, company id, entity id) with one version per $expand, and
+    the ids matching a filter value are cached per (record type, company id, field, filter value).
+    A filter value is only cached when it matched entities, so entities created later are still found.
+    At most max_size entities are kept, the least recently used ones are evicted first
+    """
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._entities: "OrderedDict[Tuple[str, str, str], Dict[Optional[str], dict]]" = OrderedDict()
+        self._filter_ids: Dict[Tuple[str, str, str, Any], List[str]] = {}
+        # filter values of each entity, to drop them when the entity is evicted
+        self._entity_filters: Dict[Tuple[str, str, str], set] = {}
+        # entities are written through by the worker threads upserting records
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_filter_ids(self, record_type: str, company_id: str, field: str, value: Any) -> Optional[List[str]]:
+        with self._lock:
+            return self._filter_ids.get((record_type, company_id, field, value))
+
+    def get_entity(self, record_type: str, company_id: str, entity_id: str, expand: Optional[str] = None) -> Optional[dict]:
+        key = (record_type, company_id, entity_id)
+        with self._lock:
+            entity = self._entities.get(key, {}).get(expand)
+            if entity is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entities.move_to_end(key)
+            return entity
+
+    def put_entities(self, record_type: str, company_id: str, entities: List[dict], expand: Optional[str] = None):
+        with self._lock:
+            for entity in entities:
+                if entity.get("id") is None:
+                    continue
+                key = (record_type, company_id, entity["id"])
+                self._entities.setdefault(key, {})[expand] = entity
+                self._entities.move_to_end(key)
+            self._evict()
+
+    def put_filter_ids(self, record_type: str, company_id: str, field: str, value: Any, entity_ids: List[str]):
+        filter_key = (record_type, company_id, field, value)
+        with self._lock:
+            # the filter value can't be answered if any of its entities was already evicted
+            if any((record_type, company_id, entity_id) not in self._entities for entity_id in entity_ids):
+                return
+
+            self._filter_ids[filter_key] = entity_ids
+            for entity_id in entity_ids:
+                self._entity_filters.setdefault((record_type, company_id, entity_id), set()).add(filter_key)
+
+    def write(self, record_type: str, company_id: str, entity: dict, filter_values: Dict[str, Any]):
+        """
+        Writes through an entity returned by a successful upsert, and the filter values (field -> formatted
+        value) it's looked up by. The entity is added to the entities already cached for the filter value.
+
+        Only lookups without $expand are answered by the written entity: its expanded versions are dropped,
+        as the upsert doesn't return the expanded entities, so lookups with $expand fetch it again
+        """
+        if entity.get("id") is None:
+            return
+
+        key = (record_type, company_id, entity["id"])
+        with self._lock:
+            self._entities[key] = {None: entity}
+            self._entities.move_to_end(key)
+            for field, value in filter_values.items():
+                filter_key = (record_type, company_id, field, value)
+                entity_ids = self._filter_ids.get(filter_key, [])
+                if entity["id"] not in entity_ids:
+                    self._filter_ids[filter_key] = entity_ids + [entity["id"]]
+                self._entity_filters.setdefault(key, set()).add(filter_key)
+            self._evict()
+
+    def invalidate(self, record_type: str, company_id: str, entity_id: str):
+        """Drops an entity updated in Dynamics, so it's fetched again the next time it's looked up"""
+        with self._lock:
+            self._drop((record_type, company_id, entity_id))
+
+    def _drop(self, key: Tuple[str, str, str]):
+        self._entities.pop(key, None)
+        for filter_key in self._entity_filters.pop(key, set()):
+            entity_ids = self._filter_ids.get(filter_key)
+            if entity_ids is not None and key[2] in entity_ids:
+                # the other entities that matched the filter value are not enough to answer it
+                self._filter_ids.pop(filter_key, None)
+
+    def _evict(self):
+        while len(self._entities) > self.max_size:
+            key = next(iter(self._entities))
+            self._drop(key)
+
+    def get_metrics(self) -> Dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entities)}
+
 class InvalidConfigurationError(Exception):
     pass
 
@@ -117,5 +316,30 @@ class Company(TypedDict):
     accounts: List[Account]
     locations: List[Location]
 
+class LazyCompany(dict):
+    """
+    Company whose reference data collections are loaded on first access. load_companies loads the
+    collections of several companies together, so the companies of a batch can be prefetched at once
+    """
+    def __init__(self, company: dict, collections: List[str], load_companies: Callable[[List["LazyCompany"], List[str]], None]) -> None:
+        super().__init__(company)
+        self.collections = collections
+        self._load_companies = load_companies
+
+    def get_missing_collections(self, collections: List[str]) -> List[str]:
+        return [collection for collection in collections if not dict.__contains__(self, collection)]
+
+    def _load(self, key: Any):
+        if key in self.collections and not dict.__contains__(self, key):
+            self._load_companies([self], [key])
+
+    def __getitem__(self, key: Any) -> Any:
+        self._load(key)
+        return super().__getitem__(key)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        self._load(key)
+        return super().get(key, default)
+
 class ReferenceData(TypedDict):
     companies: List[Company]